@@ -0,0 +1,222 @@
+# This file handles benchmarking the solver on generated boards, comparing runs to catch regressions and checking the modes that should agree do
+#builtin
+import argparse
+import json
+import math
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+#ours
+from breacher import Breacher, ORDERINGS, SOLVER_MODES
+
+CODES = ['1C', '55', '7A', 'BD', 'E9', 'FF']
+GRID_SIZES = (5, 6, 7, 8)
+BUFFER_SIZES = (4, 10)
+DAEMON_COUNTS = (1, 4)
+DAEMON_LENGTHS = (2, 4)
+DEFAULT_BOARDS = 5 #per grid size
+DEFAULT_REPEATS = 3
+DEFAULT_TIME_BUDGET = 10 #seconds per solve, so one bad board can't stall the run
+DEFAULT_THRESHOLD = 0.25 #fraction worse than the baseline before it counts as a regression
+CHECK_GRID_SIZES = (5, 6) #the check solves without a budget, so its boards are kept small
+CHECK_BUFFER_SIZES = (6, 7) #long enough for ties between different orders of the same cells
+CHECK_BOARDS = 100 #per grid size
+CHECK_MODES = ('optimal', 'parallel', 'frontier') #the modes that have to give exactly the same result as the optimal search without a transposition table
+
+def generate_boards(seed, per_size=DEFAULT_BOARDS, grid_sizes=GRID_SIZES, buffer_sizes=BUFFER_SIZES):
+    '''Reproducible random boards, per_size of each grid size. Each daemon after the first starts with the last few codes
+    of the one before it (sometimes none), so boards cover a mix of overlaps'''
+    rng = random.Random(seed)
+    boards = []
+    for size in grid_sizes:
+        for _ in range(per_size):
+            grid = [[rng.choice(CODES) for _ in range(size)] for _ in range(size)]
+            daemons = []
+            for _ in range(rng.randint(*DAEMON_COUNTS)):
+                length = rng.randint(*DAEMON_LENGTHS)
+                overlap = 0
+                if daemons:
+                    overlap = rng.randint(0, min(length, len(daemons[-1])) - 1)
+                daemon = daemons[-1][len(daemons[-1]) - overlap:] if overlap else []
+                daemons.append(daemon + [rng.choice(CODES) for _ in range(length - overlap)])
+            boards.append({
+                'grid': grid,
+                'targets': daemons,
+                'buffer_size': rng.randint(*buffer_sizes)
+            })
+    return boards
+
+def percentile(values, pct):
+    '''Nearest rank percentile'''
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def solve_board(board, mode, repeats, time_budget, ordering='index'):
+    '''Solves the board repeats times for the wall time (median of the repeats) and once more under tracemalloc for the peak memory.
+    Peak memory is only the calling process, so it leaves out the workers of the parallel mode'''
+    times = []
+    for _ in range(repeats):
+        breach = Breacher(board['grid'], board['targets'], board['buffer_size'])
+        start = time.perf_counter()
+        seq, score = breach.solve(mode=mode, time_budget=time_budget, ordering=ordering)
+        times.append(time.perf_counter() - start)
+
+    memory_breach = Breacher(board['grid'], board['targets'], board['buffer_size'])
+    tracemalloc.start()
+    memory_breach.solve(mode=mode, time_budget=time_budget, ordering=ordering)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'time': statistics.median(times),
+        'score': score,
+        'length': len(seq),
+        'nodes_expanded': breach.nodes_expanded,
+        'total_tested': breach.total_tested,
+        'peak_frontier': breach.peak_frontier,
+        'peak_memory': peak_memory,
+        'budget_exhausted': breach.budget_exhausted
+    }
+
+def summarize(runs):
+    times = [run['time'] for run in runs]
+    return {
+        'boards': len(runs),
+        'median_time': statistics.median(times),
+        'p95_time': percentile(times, 95),
+        'total_time': sum(times),
+        'median_nodes': statistics.median(run['nodes_expanded'] for run in runs),
+        'total_nodes': sum(run['nodes_expanded'] for run in runs),
+        'max_peak_memory': max(run['peak_memory'] for run in runs),
+        'total_score': sum(run['score'] for run in runs),
+        'budget_exhausted': sum(1 for run in runs if run['budget_exhausted'])
+    }
+
+def run_benchmark(seed=0, per_size=DEFAULT_BOARDS, modes=SOLVER_MODES, repeats=DEFAULT_REPEATS, time_budget=DEFAULT_TIME_BUDGET, verbose=True, ordering='index'):
+    '''Runs every mode over the generated boards with the given move ordering. Returns the results, summarized by mode and by mode and grid size'''
+    boards = generate_boards(seed, per_size)
+    results = {
+        'meta': {
+            'seed': seed,
+            'boards_per_size': per_size,
+            'repeats': repeats,
+            'time_budget': time_budget,
+            'ordering': ordering,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'timestamp': time.time()
+        },
+        'modes': {},
+        'by_size': {},
+        'runs': {}
+    }
+    for mode in modes:
+        runs = []
+        for index, board in enumerate(boards):
+            run = solve_board(board, mode, repeats, time_budget, ordering)
+            run['grid_size'] = len(board['grid'])
+            runs.append(run)
+            if verbose:
+                print('{0} board {1}/{2}: {3:.4f}s, {4} nodes, score {5}'.format(mode, index + 1, len(boards), run['time'], run['nodes_expanded'], run['score']))
+        results['runs'][mode] = runs
+        results['modes'][mode] = summarize(runs)
+        results['by_size'][mode] = {str(size): summarize([run for run in runs if run['grid_size'] == size]) for size in GRID_SIZES}
+    return results
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    '''Compares two benchmark results, returns a list of regressions (empty if there are none).
+    Times, nodes and memory regress when they grow by more than threshold, scores regress whenever they drop'''
+    regressions = []
+    if baseline['meta']['seed'] != current['meta']['seed'] or baseline['meta']['boards_per_size'] != current['meta']['boards_per_size']:
+        regressions.append('Runs used different boards, seed/boards_per_size must match')
+        return regressions
+    for mode, old in baseline['modes'].items():
+        new = current['modes'].get(mode)
+        if new is None:
+            continue
+        for field in ('median_time', 'p95_time', 'total_nodes', 'max_peak_memory'):
+            if old[field] > 0 and new[field] > old[field] * (1 + threshold):
+                regressions.append('{0} {1}: {2:.4g} -> {3:.4g} ({4:+.0%})'.format(mode, field, old[field], new[field], new[field] / old[field] - 1))
+        if new['total_score'] < old['total_score'] - 1e-9:
+            regressions.append('{0} total_score: {1:.4f} -> {2:.4f}'.format(mode, old['total_score'], new['total_score']))
+    return regressions
+
+def check_modes(seed=0, per_size=CHECK_BOARDS, modes=CHECK_MODES, verbose=True):
+    '''Solves small generated boards with each mode and move ordering, returns a list of the ones that don't give the same sequence and score
+    as the optimal search without a transposition table (empty if they all do). Ties have to go to the same (lowest) positions too'''
+    mismatches = []
+    boards = generate_boards(seed, per_size, CHECK_GRID_SIZES, CHECK_BUFFER_SIZES)
+    for index, board in enumerate(boards):
+        expected = Breacher(board['grid'], board['targets'], board['buffer_size']).solve(mode='optimal', table_size=0)
+        for mode in modes:
+            for ordering in ORDERINGS:
+                result = Breacher(board['grid'], board['targets'], board['buffer_size']).solve(mode=mode, ordering=ordering)
+                if result != expected:
+                    mismatches.append('board {0} {1} {2}: {3} instead of {4}'.format(index, mode, ordering, result, expected))
+        if verbose:
+            print('board {0}/{1}: {2} mismatches so far'.format(index + 1, len(boards), len(mismatches)))
+    return mismatches
+
+def print_summary(results):
+    print('{0:<12} {1:>10} {2:>10} {3:>12} {4:>12} {5:>10}'.format('mode', 'median s', 'p95 s', 'nodes', 'peak mem', 'exhausted'))
+    for mode, summary in results['modes'].items():
+        print('{0:<12} {1:>10.4f} {2:>10.4f} {3:>12} {4:>12} {5:>10}'.format(
+            mode, summary['median_time'], summary['p95_time'], summary['total_nodes'], summary['max_peak_memory'], summary['budget_exhausted']))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the solver modes on generated boards.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmark and write the results as JSON')
+    run_parser.add_argument('-o', '--output', default='benchmark.json')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--boards', type=int, default=DEFAULT_BOARDS, help='boards per grid size')
+    run_parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    run_parser.add_argument('--modes', nargs='+', choices=SOLVER_MODES, default=list(SOLVER_MODES))
+    run_parser.add_argument('--time-budget', type=float, default=DEFAULT_TIME_BUDGET, help='seconds per solve')
+    run_parser.add_argument('--ordering', choices=ORDERINGS, default='index', help='move ordering, compare runs with different orderings to see the difference')
+    run_parser.add_argument('--quiet', action='store_true')
+
+    compare_parser = commands.add_parser('compare', help='compare results against a baseline, exits with 1 on regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    check_parser = commands.add_parser('check', help='check the modes that should match the optimal search do, exits with 1 if any don\'t')
+    check_parser.add_argument('--seed', type=int, default=0)
+    check_parser.add_argument('--boards', type=int, default=CHECK_BOARDS, help='boards per grid size')
+    check_parser.add_argument('--modes', nargs='+', choices=CHECK_MODES, default=list(CHECK_MODES))
+    check_parser.add_argument('--quiet', action='store_true')
+
+    args = parser.parse_args(argv)
+    if args.command == 'check':
+        mismatches = check_modes(args.seed, args.boards, args.modes, not args.quiet)
+        for mismatch in mismatches:
+            print('MISMATCH', mismatch)
+        if not mismatches:
+            print('All modes match')
+        return 1 if mismatches else 0
+    if args.command == 'run':
+        results = run_benchmark(args.seed, args.boards, args.modes, args.repeats, args.time_budget, not args.quiet, args.ordering)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print_summary(results)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    for regression in regressions:
+        print('REGRESSION', regression)
+    if not regressions:
+        print('No regressions')
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
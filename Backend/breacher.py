@@ -1,18 +1,54 @@
+import collections
+import concurrent.futures
 import copy
+import heapq
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import threading
 import time
 
+SOLVER_MODES = ('best_first', 'optimal', 'parallel', 'superstring', 'frontier')
+ORDERINGS = ('index', 'target') # how the search orders the moves along a line, see solve
+TRANSPOSITION_TABLE_SIZE = 1 << 16 # default number of search states remembered for skipping duplicates
+BATCH_CHUNK_SIZE = 16 # most boards sent to a pool process at a time by solve_batch
+BATCH_CHUNKS_PER_WORKER = 4 # chunks solve_batch aims to give each pool process, so they all get work and finish about together
+FRONTIER_SEED_NODES = 2000 # best first expansions the frontier mode runs to get a score to prune against
+FRONTIER_MAX_PAIRS = 1 << 20 # automaton states times completed target combinations the frontier mode keeps a table of values for
+FRONTIER_MAX_WIDTH = 1 << 17 # most sequences the frontier mode keeps per depth, past that only the best are kept (like beam_width) so memory stays bounded
+FRONTIER_HASH_MULTIPLIER = -7046029254386353131 # odd, so it spreads the rest of a frontier state over all 64 bits before it's mixed with the used cells
+PARALLEL_SLOTS = 64 # parallel solves that can share the process pool at once, more wait for one to finish
+CANCEL_POLL_INTERVAL = 0.05 # seconds between the parallel mode checking whether it has been cancelled
+
+logger = logging.getLogger(__name__)
+
 class Breacher(object):
     def __init__(self, grid=None, targets=None, buffer_size=0) -> None:
         super().__init__()
         self.grid = []
         self.targets = []
         self.target_strs = []
+        self.rows = 0
+        self.cols = 0
+        self.blocked_cells = 0
+        self.row_index = [] # for each row, code -> bitmask of the cells in that row holding it
+        self.col_index = [] # same for each column
         self.buffer_size = 0
         self.smallest_target = 0
         self.max_value = 0
         self.total_tested = 0
         self.total_solutions = 0
-        self.open_sequences = {} # key is score, value is list of sequences with that score
+        self.total_pruned = 0
+        self.table_hits = 0
+        self.table_misses = 0
+        self.peak_frontier = 0
+        self.nodes_expanded = 0
+        self.budget_exhausted = False
+        self.proven_optimal = False
+        self.superstrings = None
+        self.open_sequences = [] # heap of (-score, insertion order, node, upper bound) so the best and then oldest is always first
         if grid: self.set_grid(grid)
         if targets and buffer_size: self.set_targets(targets, buffer_size)
 
@@ -26,6 +62,21 @@ class Breacher(object):
     def set_grid(self, the_grid):
         '''Sets the grid to the provided value (2D array of the text values)'''
         self.grid = copy.deepcopy(the_grid)
+        self.rows = len(self.grid)
+        self.cols = len(self.grid[0]) if self.grid else 0
+        #cells that start out empty can never be chosen, treat them as already used
+        self.blocked_cells = 0
+        self.row_index = [{} for _ in range(self.rows)]
+        self.col_index = [{} for _ in range(self.cols)]
+        for x in range(self.rows):
+            for y in range(self.cols):
+                code = self.grid[x][y]
+                cell = 1 << (x*self.cols + y)
+                if code == '':
+                    self.blocked_cells |= cell
+                    continue
+                self.row_index[x][code] = self.row_index[x].get(code, 0) | cell
+                self.col_index[y][code] = self.col_index[y].get(code, 0) | cell
 
     def set_targets(self, targets, buffer_size):
         '''Sets the target sequences, should be given in lowest to highest value'''
@@ -41,110 +92,693 @@ class Breacher(object):
             if tgt_len < self.smallest_target: self.smallest_target = tgt_len
             self.target_strs.append(''.join(str(s) for s in tgt))
             self.max_value += pow(2, i)
+        self._build_automaton()
+        self.superstrings = None # built the first time the superstring mode needs them
+
+    def _build_automaton(self):
+        '''Compiles all of the targets into a single Aho-Corasick automaton over the code symbols.
+        Extending a sequence by one code is then a single lookup in self.transitions, and the targets completed by reaching a state are in self.state_completes'''
+        self.symbols = {} # code text -> symbol index
+        for tgt in self.targets:
+            for s in tgt:
+                self.symbols.setdefault(str(s), len(self.symbols))
+        num_symbols = len(self.symbols)
+
+        #build the trie, state 0 is the root (empty sequence)
+        children = [{}]
+        prefix_of = [[]] # for each state, the (target index, prefix character length, prefix code length) it is a prefix of
+        ends = [0] # for each state, bitmask of the targets that end there
+        for i in range(len(self.targets)):
+            state = 0
+            symbols = [str(s) for s in self.targets[i]]
+            for k in range(len(symbols)):
+                #partial credit is only ever given for proper prefixes
+                prefix_of[state].append((i, len(''.join(symbols[:k])), k))
+                nxt = children[state].get(self.symbols[symbols[k]])
+                if nxt is None:
+                    nxt = len(children)
+                    children[state][self.symbols[symbols[k]]] = nxt
+                    children.append({})
+                    prefix_of.append([])
+                    ends.append(0)
+                state = nxt
+            ends[state] |= 1 << i
+
+        #breadth first to fill in the failure links and the full transition table
+        num_states = len(children)
+        fail = [0] * num_states
+        self.transitions = [None] * num_states
+        self.transitions[0] = [children[0].get(s, 0) for s in range(num_symbols)] + [0] # last column is for codes in no target
+        self.state_completes = [0] * num_states
+        self.state_completes[0] = ends[0]
+        state_prefixes = [None] * num_states # every target prefix that the sequence currently ends with
+        state_prefixes[0] = []
+        queue = [0]
+        for state in queue:
+            if state != 0:
+                row = list(self.transitions[fail[state]])
+                for s, nxt in children[state].items():
+                    row[s] = nxt
+                self.transitions[state] = row
+                self.state_completes[state] = ends[state] | self.state_completes[fail[state]]
+                state_prefixes[state] = prefix_of[state] + state_prefixes[fail[state]]
+            for s, nxt in children[state].items():
+                fail[nxt] = self.transitions[fail[state]][s] if state != 0 else 0
+                queue.append(nxt)
+
+        #a sequence ending in a state gets 0.01 per character for the start of each incomplete target that it ends with
+        #it also needs at least (target length - longest of those prefixes) more codes to complete each target
+        self.state_credits = []
+        self.state_needs = []
+        for state in range(num_states):
+            credits = [[] for _ in self.targets]
+            needs = [len(tgt) for tgt in self.targets]
+            for i, prefix_len, k in sorted(state_prefixes[state]):
+                if prefix_len > 0 and prefix_len % 2 == 0:
+                    credits[i].append(0.01*prefix_len)
+                needs[i] = min(needs[i], len(self.targets[i]) - k)
+            self.state_credits.append(credits)
+            self.state_needs.append(needs)
+        #the most partial credit a target can ever give, when the sequence ends with every one of its proper prefixes
+        self.max_credits = []
+        for tgt_str in self.target_strs:
+            self.max_credits.append(sum(0.01*j for j in range(2, len(tgt_str), 2)))
+        self.score_table = {} # (state, completed targets) -> value without the length bonus, filled in as the search finds them
+        self.bound_table = {} # (state, completed targets, codes remaining) -> upper bound on the value of any extension
+        self.line_bound_table = {} # (state, completed targets, codes remaining, symbols left in the next line) -> the same, knowing the next line
+        self.advancing_table = {} # (state, completed targets) -> symbols that move an incomplete target closer to completion
+
+    def _base_value(self, state, completed):
+        '''Gets the value of a sequence in the given automaton state that has completed the given targets, not including the length bonus'''
+        key = (state, completed)
+        total_value = self.score_table.get(key)
+        if total_value is None:
+            total_value = 0
+            credits = self.state_credits[state]
+            for i in range(len(self.targets)):
+                if completed >> i & 1: total_value += pow(2, i)
+                else:
+                    for credit in credits[i]:
+                        total_value += credit
+            self.score_table[key] = total_value
+        return total_value
 
-    def solve(self, shortest=False):
-        '''Using the provided grid and targets, returns the best sequence (first) and score (second)'''
+    def _upper_bound(self, state, completed, length):
+        '''Upper bound on the score of any sequence that extends one of the given length, automaton state and completed targets.
+        Every target that could still be finished in the remaining buffer counts as finished, the rest get their most possible partial credit'''
+        remaining = self.buffer_size - length
+        key = (state, completed, remaining)
+        total_value = self.bound_table.get(key)
+        if total_value is None:
+            total_value = 0
+            needs = self.state_needs[state]
+            for i in range(len(self.targets)):
+                if completed >> i & 1: total_value += pow(2, i)
+                elif needs[i] <= remaining: total_value += max(pow(2, i), self.max_credits[i])
+                else: total_value += self.max_credits[i]
+            self.bound_table[key] = total_value
+        #extensions are at least one longer, so the bonus can only go down from there
+        return total_value + 0.1 * (1 - ((length + 1)/self.buffer_size))
+
+    def _line_bound(self, state, completed, length, available):
+        '''_upper_bound, also knowing the symbols (bitmask) still free in the line the next move is made along.
+        A target only counts as finishable if one of those symbols leaves it finishable in what is left of the buffer after that move'''
+        remaining = self.buffer_size - length
+        key = (state, completed, remaining, available)
+        total_value = self.line_bound_table.get(key)
+        if total_value is None:
+            total_value = 0
+            needs = self.state_needs[state]
+            nexts = [self.transitions[state][s] for s in range(len(self.symbols) + 1) if available >> s & 1]
+            for i in range(len(self.targets)):
+                if completed >> i & 1: total_value += pow(2, i)
+                elif needs[i] <= remaining and any(self.state_completes[t] >> i & 1 or self.state_needs[t][i] < remaining for t in nexts):
+                    total_value += max(pow(2, i), self.max_credits[i])
+                else: total_value += self.max_credits[i]
+            self.line_bound_table[key] = total_value
+        return total_value + 0.1 * (1 - ((length + 1)/self.buffer_size))
+
+    def _advancing_symbols(self, state, completed):
+        '''The symbols that take the given state closer to completing a target that isn't completed yet'''
+        key = (state, completed)
+        symbols = self.advancing_table.get(key)
+        if symbols is None:
+            needs = self.state_needs[state]
+            symbols = []
+            for s in range(len(self.symbols) + 1):
+                nxt = self.transitions[state][s]
+                pending = ~completed & ((1 << len(self.targets)) - 1)
+                if self.state_completes[nxt] & pending or any(pending >> i & 1 and self.state_needs[nxt][i] < needs[i] for i in range(len(self.targets))):
+                    symbols.append(s)
+            self.advancing_table[key] = symbols
+        return symbols
+
+    def _line_masks(self):
+        '''The row and column code indexes by automaton symbol, as (rows, columns) where each line is a list of symbol -> cells bitmask'''
+        other = len(self.symbols)
+        def by_symbol(index):
+            lines = []
+            for codes in index:
+                masks = [0] * (other + 1)
+                for code, cells in codes.items():
+                    masks[self.symbols.get(str(code), other)] |= cells
+                lines.append(masks)
+            return lines
+        return by_symbol(self.row_index), by_symbol(self.col_index)
+
+    def _cell_symbols(self):
+        '''Maps each grid cell (flattened) to its automaton symbol'''
+        other = len(self.symbols)
+        return [self.symbols.get(str(self.grid[x][y]), other) for x in range(self.rows) for y in range(self.cols)]
+
+    def _build_superstrings(self):
+        '''Lays out every subset of the targets in every way that fits in the buffer, each target starting no earlier than the one before it.
+        Targets can overlap where their codes agree and can have filler (None) between them.
+        Returns a list of (targets bitmask, layouts sorted by length) with the most valuable subset first'''
+        codes = [[self.symbols[str(s)] for s in tgt] for tgt in self.targets]
+        superstrings = []
+        def place(layout, remaining, last_start, layouts):
+            if not remaining:
+                layouts.add(tuple(layout))
+                return
+            for i in remaining:
+                tgt = codes[i]
+                #the first target always starts at 0, any lead-in is added when embedding
+                starts = range(last_start, self.buffer_size - len(tgt) + 1) if layout else [0]
+                for start in starts:
+                    new_layout = layout + [None] * max(0, start + len(tgt) - len(layout))
+                    for k in range(len(tgt)):
+                        if new_layout[start+k] is None: new_layout[start+k] = tgt[k]
+                        elif new_layout[start+k] != tgt[k]: break
+                    else:
+                        place(new_layout, [j for j in remaining if j != i], start, layouts)
+        for mask in range(pow(2, len(self.targets)) - 1, 0, -1): #the bitmask is also the value of the subset
+            layouts = set()
+            place([], [i for i in range(len(self.targets)) if mask >> i & 1], 0, layouts)
+            if layouts:
+                superstrings.append((mask, sorted(layouts, key=lambda l: (len(l), [-1 if c is None else c for c in l]))))
+        return superstrings
+
+    def solve(self, shortest=False, beam_width=None, mode='best_first', table_size=TRANSPOSITION_TABLE_SIZE, workers=None,
+              time_budget=None, node_budget=None, on_improve=None, ordering='index', cancel=None):
+        '''Using the provided grid and targets, returns the best sequence (first) and score (second).
+        The 'best_first' mode returns the first sequence that completes every target. The 'optimal' mode keeps going with branch and bound
+        until the highest scoring sequence (the shortest one that completes every target, if there is one) is proven, so it covers shortest=True as well.
+        Ties go to the sequence with the lowest positions. The 'parallel' mode gives the same result as 'optimal' by solving each first move in its own process (up to workers at once).
+        The 'superstring' mode only looks for paths that spell out a precomputed layout of the targets, most valuable targets first.
+        The 'frontier' mode gives the same result as 'optimal' by expanding a whole depth at a time with numpy (needed for this mode), for grids of up to 64 cells and a handful of targets.
+        If beam_width is given the open sequences are trimmed back to the best beam_width whenever they grow past twice that, which bounds memory but may miss solutions.
+        Sequences that reach the same used cells, line and target progress as an earlier one have the same future and are skipped,
+        table_size caps how many of those states are remembered (least recently seen are forgotten first), 0 turns it off.
+        time_budget (seconds) and node_budget (sequences expanded) stop the search early with the best sequence found so far,
+        afterwards proven_optimal says whether the result is known to be the best possible and budget_exhausted whether the search was cut short.
+        on_improve(sequence, score) is called every time a better sequence is found.
+        cancel is a threading.Event that stops the search the same way the budgets do once it's set.
+        ordering is how the moves along a line are tried: 'index' in position order, 'target' with the cells whose code moves an incomplete target
+        closer to completion first, and with sequences that can't beat the best so far pruned, counting only targets the codes left in the next line can still finish'''
         if self.buffer_size <= 0 or len(self.targets) == 0 or len(self.grid) == 0:
-            print('Inavlid setup')
+            logger.warning('Inavlid setup')
+            return [], 0.0
+        if mode not in SOLVER_MODES:
+            logger.warning('Unknown solver mode %s', mode)
+            return [], 0.0
+        if ordering not in ORDERINGS:
+            logger.warning('Unknown move ordering %s', ordering)
             return [], 0.0
 
         self.total_tested = 0
         self.total_solutions = 0
-        self.open_sequences = {}
+        self.total_pruned = 0
+        self.table_hits = 0
+        self.table_misses = 0
+        self.peak_frontier = 0
+        self.nodes_expanded = 0
+        self.budget_exhausted = False
+        self.proven_optimal = False
+        self.open_sequences = []
         self.shortest_solution = self.buffer_size
-        
-        best_sequence = []
+        deadline = None
+        if time_budget is not None:
+            deadline = time.monotonic() + time_budget
+
+        if mode == 'superstring':
+            return self._solve_superstring(self._cell_symbols(), deadline, node_budget, on_improve, ordering, cancel)
+        if mode == 'parallel':
+            return self._solve_parallel(beam_width, table_size, workers, deadline, node_budget, on_improve, ordering, cancel)
+        if mode == 'frontier' and (self.rows * self.cols > 64 or len(self.transitions) << len(self.targets) > FRONTIER_MAX_PAIRS):
+            logger.info('Board too big for the frontier mode, using the optimal mode')
+            mode = 'optimal'
+        if mode == 'frontier':
+            seq, score = self._solve_frontier(beam_width, deadline, node_budget, on_improve, cancel)
+        else:
+            seq, score = self._search(shortest, beam_width, mode == 'optimal', table_size, deadline=deadline, node_budget=node_budget, on_improve=on_improve,
+                                      ordering=ordering, cancel=cancel)
+        self.proven_optimal = mode in ('optimal', 'frontier') and not beam_width and not self.budget_exhausted
+        if score < self.max_value:
+            #if we got here then we haven't found a perfect option
+            logger.info('No valid solutions! Returning best solution found.')
+        return seq, score
+
+    def solve_progressive(self, **kwargs):
+        '''Generator version of solve, takes the same arguments. Runs the solve in a background thread and yields (sequence, score)
+        every time a better sequence is found, ending with the final result. Closing the generator early cancels the solve'''
+        improvements = queue.Queue()
+        result = []
+        errors = []
+        stop = threading.Event()
+        def run():
+            try:
+                result.extend(self.solve(on_improve=lambda seq, score: improvements.put((seq, score)), cancel=stop, **kwargs))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                improvements.put(None)
+        solver = threading.Thread(target=run, daemon=True)
+        solver.start()
+        last = None
+        try:
+            while True:
+                improved = improvements.get()
+                if improved is None:
+                    break
+                last = improved
+                yield improved
+        finally:
+            stop.set() #nobody is waiting on the rest if the generator was closed early
+        solver.join()
+        if errors:
+            raise errors[0]
+        if result and tuple(result) != last:
+            yield tuple(result)
+
+    def _search(self, shortest, beam_width, optimal, table_size, first_moves=None, shared_best=None, deadline=None, node_budget=None, on_improve=None, ordering='index',
+                cancel=None):
+        '''The search behind solve. first_moves limits which cells of the first row are tried,
+        and shared_best is a multiprocessing value holding the best score any other process has found so far, both used by the parallel mode.
+        The search stops with the best found so far once the budget runs out, see _out_of_budget'''
+        pushed = 0
+        seen = collections.OrderedDict() # (used cells, next line, automaton state, completed targets) transposition table, of the path that got there for the optimal search
+
+        best_node = None
         best_score = 0.0
+        best_positions = []
+        outside_best = 0.0 # best score found by the other processes, only strictly better scores than it can be pruned since ties go by positions
 
+        cell_symbols = self._cell_symbols()
+        transitions = self.transitions
+        state_completes = self.state_completes
+        by_target = ordering == 'target'
+        line_masks = self._line_masks() if by_target else None
+        #also gets a bonus of up to 0.1 points for being under the max size
+        bonuses = [0.1 * (1 - (length/self.buffer_size)) for length in range(self.buffer_size + 1)]
+
+        # a node is (path, length, used cells bitmask, last row, last column, automaton state, completed targets bitmask)
+        # the path is a linked list of (position, parent path) so children share their parent's path
+        node = (None, 0, self.blocked_cells, 0, 0, 0, state_completes[0])
         searching = True
 
-        while searching:
-            # pick the best scoring option from the list of open sequences
-            # check the new options and add them to the open list
-            # repeat until a solution is found
-            highest_score = 0 if not self.open_sequences else sorted(self.open_sequences.keys(), reverse=True)[0]
-            seq = [] #if we're just starting out we have an empty sequence
-            if highest_score > 0:
-                sequences = self.open_sequences[highest_score] #grab the list of sequences with that score
-                seq = sequences.pop(0) #grab the first sequence in the list of sequences, it's the oldest
-                if not sequences: #list empty now, remove from the open_sequences
-                    del self.open_sequences[highest_score]
-                if not self.open_sequences:
-                    searching = False #we've run out out options
-            last = (0,0) #the last element in the sequence
-            if seq: last = seq[-1]
-            isColumn = (len(seq) % 2) == 1
-            remaining_grid = self._build_remaining_grid(self.grid, seq) #empty out all the elements that have been chosen in the sequence
-            options = self._build_options(remaining_grid, seq, last[0], last[1], isColumn) #get all the new options
-            # print(self.positions_to_text(seq))
+        while True:
+            # expand the current node, adding its children to the list of open sequences
+            # then pick the best scoring option from the open sequences and repeat until a solution is found
+            path, seq_len, used, x, y, state, completed = node
+            self.nodes_expanded += 1
+            isColumn = (seq_len % 2) == 1
+            new_seq_len = seq_len + 1
+            bonus = bonuses[new_seq_len]
+            if by_target: options = self._target_options(used, x, y, isColumn, state, completed, line_masks)
+            else: options = self._build_options(used, x, y, isColumn)
+            if seq_len == 0 and first_moves is not None:
+                options = [i for i in options if i in first_moves]
             for i in options: #loop over the options, get the value of the new sequence if we chose that one
-                new_pos = (last[0], i)
-                if isColumn: new_pos = (i, last[1])
-                new_seq = seq + [new_pos]
-                score = self.get_value(new_seq)
-                new_seq_len = len(new_seq)
+                new_pos = (x, i)
+                if isColumn: new_pos = (i, y)
+                cell = new_pos[0]*self.cols + new_pos[1]
+                new_state = transitions[state][cell_symbols[cell]]
+                new_completed = completed | state_completes[new_state]
+                new_node = ((new_pos, path), new_seq_len, used | (1 << cell), new_pos[0], new_pos[1], new_state, new_completed)
+                score = self._base_value(new_state, new_completed) + bonus
                 if score > best_score:
                     best_score = score
-                    best_sequence = new_seq
+                    best_node = new_node
+                    if optimal: best_positions = self._node_to_positions(new_node)
+                    if on_improve: on_improve(self._node_to_positions(new_node), score)
+                elif optimal and score == best_score:
+                    positions = self._node_to_positions(new_node)
+                    if positions < best_positions:
+                        best_node = new_node
+                        best_positions = positions
+                        if on_improve: on_improve(positions, score)
                 if score >= self.max_value:
                     self.total_tested += 1
                     self.total_solutions += 1
-                    if shortest and new_seq_len < self.shortest_solution:
+                    if not shortest and not optimal:
+                        return self._node_to_positions(new_node), score
+                    if new_seq_len < self.shortest_solution:
                         self.shortest_solution = new_seq_len
-                    elif not shortest:
-                        return new_seq, score
                 if new_seq_len >= self.buffer_size or new_seq_len > self.shortest_solution: #we can short out if we have already found a shorter one
                     self.total_tested += 1
                     continue #if it didn't succeed then we're out of buffer space
-                if score in self.open_sequences: self.open_sequences[score].append(new_seq)
-                else: self.open_sequences[score] = [new_seq] #add the new sequence and score to the open_sequences
-        #if we got here then we haven't found a perfect option
-        print('No valid solutions! Returning best solution found.')
+                if table_size:
+                    key = (new_node[2], i, new_state, new_completed) #the index just picked is the line the next move is made from
+                    if key in seen:
+                        seen.move_to_end(key)
+                        #already got here by another order, its children are the same. Unless this way has lower positions,
+                        #which the optimal search has to keep since ties go to them
+                        if not optimal or self._path_not_after(seen[key], new_node[0]):
+                            self.table_hits += 1
+                            continue
+                    self.table_misses += 1
+                    seen[key] = new_node[0] if optimal else True
+                    if len(seen) > table_size:
+                        seen.popitem(last=False)
+                bound = None
+                if optimal or by_target: #the best first search only takes strictly better scores, which is what _can_beat checks without best_positions
+                    bound = self._upper_bound(new_state, new_completed, new_seq_len)
+                    if by_target and self._can_beat(bound, new_node, best_score, best_positions, outside_best):
+                        #the next move is along the line just picked, see which codes it still has
+                        available = 0
+                        line = line_masks[not isColumn][i]
+                        for symbol in range(len(line)):
+                            if line[symbol] & ~new_node[2]: available |= 1 << symbol
+                        bound = self._line_bound(new_state, new_completed, new_seq_len, available)
+                    if not self._can_beat(bound, new_node, best_score, best_positions, outside_best):
+                        self.total_pruned += 1
+                        continue #nothing below this can beat what we already have
+                heapq.heappush(self.open_sequences, (-score, pushed, new_node, bound)) #add the new node and score to the open_sequences
+                pushed += 1
+
+            if len(self.open_sequences) > self.peak_frontier:
+                self.peak_frontier = len(self.open_sequences)
+            if beam_width and len(self.open_sequences) > 2*beam_width:
+                self.open_sequences = heapq.nsmallest(beam_width, self.open_sequences) #sorted, so still a valid heap
+            if optimal:
+                if shared_best is not None:
+                    if best_score > shared_best.value:
+                        with shared_best.get_lock():
+                            if best_score > shared_best.value: shared_best.value = best_score
+                    outside_best = shared_best.value
+                #the best score may have gone up since these were added
+                while self.open_sequences and not self._can_beat(self.open_sequences[0][3], self.open_sequences[0][2], best_score, best_positions, outside_best):
+                    heapq.heappop(self.open_sequences)
+                    self.total_pruned += 1
+            if not searching or not self.open_sequences:
+                break #nothing left to expand
+            if self._out_of_budget(deadline, node_budget, cancel):
+                break #out of time, go with the best so far
+            node = heapq.heappop(self.open_sequences)[2] #grab the highest scoring node, the oldest one if there are ties
+            if not self.open_sequences and not optimal:
+                searching = False #we've run out out options, this is the last one to expand
+        return self._node_to_positions(best_node), best_score
+
+    def _solve_frontier(self, beam_width, deadline, node_budget, on_improve, cancel=None):
+        '''Breadth first search that expands every sequence of a depth at once with numpy. A depth is stored as arrays of
+        the used cells bitmask, the line the next move is made along, the automaton state and the completed targets,
+        plus the index of each sequence's parent in the previous depth and the cell it just picked, which the winning path is rebuilt from.
+        Children come out in position order and only the first of any that reach the same state is kept, so ties go the same way as the optimal mode.
+        Sequences that can't reach the best score so far are pruned, seeded by a short best first search. With beam_width only that many of the best
+        are kept per depth, and never more than FRONTIER_MAX_WIDTH, which counts as the search being cut short. Budgets are checked before each depth'''
+        import numpy #only needed for this mode
+        symbols = numpy.array(self._cell_symbols(), numpy.int64)
+        transitions = numpy.array(self.transitions, numpy.int64)
+        state_completes = numpy.array(self.state_completes, numpy.int64)
+        target_bits = len(self.targets)
+        target_mask = (1 << target_bits) - 1
+        num_states = len(self.transitions)
+        bonuses = [0.1 * (1 - (length/self.buffer_size)) for length in range(self.buffer_size + 1)]
+
+        #the seed is also the result if the budget runs out before the first depth
+        best_positions, best_score = self._search(False, None, False, TRANSPOSITION_TABLE_SIZE, deadline=deadline, node_budget=FRONTIER_SEED_NODES, cancel=cancel)
+        self.budget_exhausted = False #that was only the seed's budget
+        prune_score = best_score
+        if on_improve and best_positions: on_improve(best_positions, best_score)
+        width = min(beam_width or FRONTIER_MAX_WIDTH, FRONTIER_MAX_WIDTH)
+
+        #the root, the first move is along row 0
+        used = numpy.array([self.blocked_cells], numpy.uint64)
+        line = numpy.zeros(1, numpy.int64)
+        state = numpy.zeros(1, numpy.int64)
+        completed = numpy.array([self.state_completes[0]], numpy.int64)
+        levels = [] # (parent index, cell) arrays of the sequences kept at each depth after the root
+
+        for depth in range(self.buffer_size):
+            if depth and self._out_of_budget(deadline, node_budget, cancel):
+                break #before building the next depth, which is the expensive part
+            self.nodes_expanded += len(used)
+            picks = numpy.arange(self.rows if depth % 2 else self.cols)
+            if depth % 2: child_cells = picks[None, :] * self.cols + line[:, None]
+            else: child_cells = line[:, None] * self.cols + picks[None, :]
+            free = (used[:, None] >> child_cells.astype(numpy.uint64)) & numpy.uint64(1) == 0
+            parent, pick = numpy.nonzero(free) #parent by parent, so the children stay in position order
+            if len(parent) == 0:
+                break
+            cell = child_cells[parent, pick]
+            new_state = transitions[state[parent], symbols[cell]]
+            new_completed = completed[parent] | state_completes[new_state]
+            self.total_tested += len(cell)
+
+            #only a few (state, completed) pairs come up, so their values come from the same tables as the other modes
+            pairs = new_state << target_bits | new_completed
+            seen = numpy.flatnonzero(numpy.bincount(pairs)).tolist()
+            values = numpy.zeros(len(self.transitions) << target_bits)
+            values[seen] = [self._base_value(p >> target_bits, p & target_mask) for p in seen]
+            scores = values[pairs] + bonuses[depth + 1]
+            self.total_solutions += int(numpy.count_nonzero(scores >= self.max_value))
+
+            top = int(numpy.argmax(scores)) #the first of the best, so the lowest positions
+            if scores[top] >= best_score:
+                positions = self._frontier_positions(levels, int(parent[top])) + [divmod(int(cell[top]), self.cols)]
+                if scores[top] > best_score or positions < best_positions:
+                    best_score = float(scores[top])
+                    best_positions = positions
+                    if on_improve: on_improve(positions, best_score)
+            if depth + 1 == self.buffer_size:
+                break
+
+            prune_score = max(prune_score, best_score)
+            values[seen] = [self._upper_bound(p >> target_bits, p & target_mask, depth + 1) for p in seen]
+            keep = numpy.flatnonzero(values[pairs] >= prune_score)
+            self.total_pruned += len(cell) - len(keep)
+            if len(keep) == 0:
+                break
+
+            #sequences in the same state have the same futures, so only the first (lowest positions) of each is kept. Sorting one
+            #hash is much faster than sorting both halves of the state, equal hashes are checked against the full state
+            new_used = (used[parent[keep]] | (numpy.uint64(1) << cell[keep].astype(numpy.uint64))).view(numpy.int64)
+            rest = ((pick[keep] * num_states + new_state[keep]) << target_bits) | new_completed[keep]
+            order = numpy.argsort(new_used ^ (rest * FRONTIER_HASH_MULTIPLIER), kind='stable')
+            repeat = (new_used[order[1:]] == new_used[order[:-1]]) & (rest[order[1:]] == rest[order[:-1]])
+            first = numpy.sort(order[numpy.concatenate(([True], ~repeat))])
+            self.table_hits += len(keep) - len(first)
+            if len(first) > width:
+                if not beam_width or width < beam_width:
+                    self.budget_exhausted = True #the cap cut it short, so the result isn't proven
+                first = numpy.sort(first[numpy.argsort(-scores[keep[first]], kind='stable')[:width]])
+            keep = keep[first]
+            used = new_used[first].view(numpy.uint64)
+            line = pick[keep]
+            state = new_state[keep]
+            completed = new_completed[keep]
+            levels.append((parent[keep], cell[keep]))
+            self.peak_frontier = max(self.peak_frontier, len(keep))
+        return best_positions, best_score
+
+    def _frontier_positions(self, levels, index):
+        '''Rebuilds the positions of the sequence at the given index of the last depth in levels'''
+        positions = []
+        for parents, cells in reversed(levels):
+            positions.append(divmod(int(cells[index]), self.cols))
+            index = int(parents[index])
+        positions.reverse()
+        return positions
+
+    def _out_of_budget(self, deadline, node_budget, cancel=None):
+        '''Whether a search has to stop, once time.monotonic() passes deadline, node_budget sequences have been expanded or cancel is set.
+        Sets budget_exhausted if so'''
+        out = (deadline is not None and time.monotonic() >= deadline) or (node_budget and self.nodes_expanded >= node_budget) or (cancel is not None and cancel.is_set())
+        if out:
+            self.budget_exhausted = True
+        return out
+
+    def _can_beat(self, bound, node, best_score, best_positions, outside_best=0.0):
+        '''Whether anything below a node with the given upper bound could beat the best so far, either with a higher score or the same score and lower positions'''
+        if bound < outside_best: return False
+        if bound != best_score: return bound > best_score
+        return self._node_to_positions(node) <= best_positions[:node[1]]
+
+    def _solve_parallel(self, beam_width, table_size, workers, deadline=None, node_budget=None, on_improve=None, ordering='index', cancel=None):
+        '''Runs the optimal search for each first move in a separate process, sharing the best score so they can prune each other.
+        Each process gets an even share of the node budget. Without workers the searches go to the process pool every parallel solve shares
+        (one process per available CPU), otherwise to a pool of workers processes just for this solve'''
+        first_moves = self._build_options(self.blocked_cells, 0, 0, False)
+        if workers is None:
+            executor, scores, slots = _shared_parallel_pool()
+        else:
+            scores = multiprocessing.Array('d', 1)
+            slots = queue.Queue()
+            slots.put(0)
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_parallel_worker, initargs=(scores,))
+        slot = slots.get()
+        shared_best = SharedScore(scores, slot)
+        shared_best.value = 0.0
+        best_sequence = []
+        best_score = 0.0
+        move_budget = None
+        if node_budget:
+            move_budget = max(1, node_budget // max(1, len(first_moves)))
+        proven = not beam_width
+        futures = []
+        try:
+            futures = [executor.submit(_solve_first_move, self.grid, self.targets, self.buffer_size, i, slot, beam_width, table_size, deadline, move_budget, ordering)
+                       for i in first_moves]
+            pending = futures
+            while cancel is not None and pending:
+                if cancel.is_set():
+                    #nothing can beat an infinite score, so every process prunes everything it has left and finishes
+                    with shared_best.get_lock():
+                        shared_best.value = float('inf')
+                    self.budget_exhausted = True
+                    proven = False
+                    break
+                pending = concurrent.futures.wait(pending, timeout=CANCEL_POLL_INTERVAL).not_done
+            for future in futures: #in first move order, so ties go the same way as the serial search
+                seq, score, stats = future.result()
+                if score > best_score or (score == best_score and seq < best_sequence):
+                    best_sequence = seq
+                    best_score = score
+                    if on_improve: on_improve(seq, score)
+                if stats['budget_exhausted']:
+                    self.budget_exhausted = True
+                    proven = False
+                self.total_tested += stats['total_tested']
+                self.total_solutions += stats['total_solutions']
+                self.total_pruned += stats['total_pruned']
+                self.table_hits += stats['table_hits']
+                self.table_misses += stats['table_misses']
+                self.peak_frontier = max(self.peak_frontier, stats['peak_frontier'])
+                self.nodes_expanded += stats['nodes_expanded']
+        except concurrent.futures.BrokenExecutor:
+            if workers is None:
+                _discard_parallel_pool(executor) #a pool process died (killed for memory, say), the next solve gets a new pool
+            raise
+        finally:
+            #the slot can only go to another solve once nothing is still writing its best score to it
+            concurrent.futures.wait(futures)
+            slots.put(slot)
+            if workers is not None:
+                executor.shutdown()
+        self.proven_optimal = proven
+        if best_score < self.max_value:
+            logger.info('No valid solutions! Returning best solution found.')
         return best_sequence, best_score
 
-    def _build_options(self, remaining, buffer, x, y, isColumn):
-        options = {}
+    def _solve_superstring(self, cell_symbols, deadline=None, node_budget=None, on_improve=None, ordering='index', cancel=None):
+        '''Tries to embed the target layouts in the grid, most valuable first and then shortest first (counting lead-in moves).
+        Falls back to the optimal search (with whatever is left of the budget) if not even a single target can be embedded
+        or the budget runs out first, in which case the result stays marked as cut short'''
+        for pattern in self._superstring_patterns():
+            positions = self._embed(pattern, cell_symbols, deadline, node_budget, cancel)
+            if positions:
+                score = self.get_value(positions)
+                if score >= self.max_value: self.total_solutions += 1
+                if on_improve: on_improve(positions, score)
+                return positions, score
+            if self.budget_exhausted:
+                break
+        exhausted = self.budget_exhausted
+        time_budget = None
+        if deadline is not None:
+            time_budget = max(0.0, deadline - time.monotonic())
+        if node_budget:
+            node_budget = max(1, node_budget - self.nodes_expanded)
+        seq, score = self.solve(mode='optimal', time_budget=time_budget, node_budget=node_budget, on_improve=on_improve, ordering=ordering, cancel=cancel)
+        if exhausted:
+            self.budget_exhausted = True
+            self.proven_optimal = False
+        return seq, score
+
+    def _superstring_patterns(self):
+        '''The patterns the superstring mode tries to embed, in the order it tries them. Lead-in moves before a layout are None'''
+        if self.superstrings is None:
+            self.superstrings = self._build_superstrings()
+        for mask, layouts in self.superstrings:
+            for length in range(len(layouts[0]), self.buffer_size + 1):
+                for layout in layouts:
+                    if len(layout) > length: break
+                    yield (None,) * (length - len(layout)) + layout
+
+    def _embed(self, pattern, cell_symbols, deadline=None, node_budget=None, cancel=None):
+        '''Depth first search for a path through the grid that spells out the pattern, where None matches any code.
+        Returns the positions or None if there is no such path or the budget runs out first (see _out_of_budget)'''
+        def step(path, used, x, y):
+            depth = len(path)
+            if depth == len(pattern): return path
+            if self._out_of_budget(deadline, node_budget, cancel): return None
+            self.nodes_expanded += 1
+            isColumn = (depth % 2) == 1
+            for i in self._build_options(used, x, y, isColumn):
+                new_pos = (x, i)
+                if isColumn: new_pos = (i, y)
+                cell = new_pos[0]*self.cols + new_pos[1]
+                if pattern[depth] is not None and cell_symbols[cell] != pattern[depth]: continue
+                self.total_tested += 1
+                found = step(path + [new_pos], used | (1 << cell), new_pos[0], new_pos[1])
+                if found or self.budget_exhausted: return found
+            return None
+        return step([], self.blocked_cells, 0, 0)
+
+    def _build_options(self, used, x, y, isColumn):
+        '''Returns the indices along the current row or column that haven't been used yet'''
         if isColumn:
-            for xG in range(len(self.grid)):
-                if remaining[xG][y] != '':
-                    options[xG] = remaining[xG][y]
-        else:
-            for yG in range(len(self.grid[0])):
-                if remaining[x][yG] != '':
-                    options[yG] = remaining[x][yG]
-        return options
-
-    def _build_remaining_grid(self, original_grid, seq):
-        remaining = copy.deepcopy(original_grid)
-        for pos in seq:
-            remaining[pos[0]][pos[1]] = ''
-        return remaining
-            
+            return [xG for xG in range(self.rows) if not used >> (xG*self.cols + y) & 1]
+        return [yG for yG in range(self.cols) if not used >> (x*self.cols + yG) & 1]
+
+    def _target_options(self, used, x, y, isColumn, state, completed, line_masks):
+        '''_build_options, but with the indices whose code moves an incomplete target closer to completion first'''
+        line = line_masks[1][y] if isColumn else line_masks[0][x]
+        advancing = 0
+        for symbol in self._advancing_symbols(state, completed):
+            advancing |= line[symbol]
+        first = []
+        rest = []
+        for i in self._build_options(used, x, y, isColumn):
+            cell = i*self.cols + y if isColumn else x*self.cols + i
+            if advancing >> cell & 1: first.append(i)
+            else: rest.append(i)
+        return first + rest
+
+    def _path_not_after(self, path, other):
+        '''Whether the positions of a path come before or are the same as another path's of the same length.
+        Only walks back to where they join, which is usually close'''
+        first = None # the earliest positions they differ at
+        while path is not other:
+            if path[0] != other[0]: first = (path[0], other[0])
+            path = path[1]
+            other = other[1]
+        return first is None or first[0] < first[1]
+
+    def _node_to_positions(self, node):
+        '''Walks a node's path back to the root to get the position sequence'''
+        positions = []
+        if node is None: return positions
+        path = node[0]
+        while path is not None:
+            positions.append(path[0])
+            path = path[1]
+        positions.reverse()
+        return positions
+
     def get_value(self, positions) -> float:
         '''Gets the value of a sequence based on the current targets'''
-        #doing this each time is wasteful, should find a way to do this incrementally instead of checking whole list
-        #loop through the sequence, check if it's close to any targets
-        #first pass ignores partials
-        #lets just use strings and the in operator at first
-        #could also prioritize moves that are closer together (less mouse travel)
-        sequence = self.positions_to_text(positions)
-        seq_str = ''.join(str(s) for s in sequence)
-        total_value = 0
-        for i in range(len(self.target_strs)):
-            value = pow(2, i)
-            tgt_str = self.target_strs[i]
-            if tgt_str in seq_str: total_value += value
-            else:
-                #check if the start of the target exists at the end of the current sequence
-                for j in range(2, len(tgt_str), 2):
-                    substr = tgt_str[:j]
-                    if seq_str.endswith(substr):
-                        total_value += 0.01*j
+        other = len(self.symbols)
+        state = 0
+        completed = self.state_completes[0]
+        for code in self.positions_to_text(positions):
+            state = self.transitions[state][self.symbols.get(str(code), other)]
+            completed |= self.state_completes[state]
         #also gets a bonus of up to 0.1 points for being under the max size
         bonus = 0.1 * (1 - (len(positions)/self.buffer_size))
-        total_value += bonus
-        return total_value
-    
+        return self._base_value(state, completed) + bonus
+
     def positions_to_text(self, positions):
         '''Convert a position sequence to the values at those positions'''
         sequence = []
@@ -153,6 +787,165 @@ class Breacher(object):
         return sequence
 
 
+class SharedScore(object):
+    '''One slot of a shared array of scores, which the search uses like a multiprocessing.Value'''
+    def __init__(self, scores, slot) -> None:
+        super().__init__()
+        self.scores = scores
+        self.slot = slot
+
+    @property
+    def value(self):
+        return self.scores[self.slot]
+
+    @value.setter
+    def value(self, value):
+        self.scores[self.slot] = value
+
+    def get_lock(self):
+        return self.scores.get_lock()
+
+def available_cpus():
+    '''How many CPUs this process can use: BREACHER_CPUS if set, otherwise the cores it may run on, capped by its container's CPU quota.
+    os.cpu_count() is the whole node's in a container, which is far too many processes for one pod'''
+    cpus = os.environ.get('BREACHER_CPUS')
+    if cpus:
+        return max(1, int(cpus))
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError: #not on every platform
+        count = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, max(1, int(quota)))
+    return count
+
+def _cgroup_cpu_quota():
+    '''The CPU quota (in CPUs) of this process's cgroup, v2 or v1, or None if it has none'''
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+_shared_scores = None
+_parallel_pool_processes = None # size of the shared pool, available_cpus() unless set_parallel_pool_processes is called first
+_parallel_pool = None # (executor, shared scores, free slots) shared by the parallel solves, made on first use since its processes wouldn't survive a fork
+_parallel_pool_lock = threading.Lock()
+
+def set_parallel_pool_processes(processes):
+    '''Sets how many processes the pool parallel solves share will have, for when several processes (gunicorn workers) each have one.
+    Only affects a pool made after this'''
+    global _parallel_pool_processes
+    _parallel_pool_processes = processes
+
+def _shared_parallel_pool():
+    '''The process pool parallel solves share, with a shared array of best scores that each solve running in it takes a slot of'''
+    global _parallel_pool
+    with _parallel_pool_lock:
+        if _parallel_pool is None:
+            scores = multiprocessing.Array('d', PARALLEL_SLOTS)
+            slots = queue.Queue()
+            for slot in range(PARALLEL_SLOTS):
+                slots.put(slot)
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=_parallel_pool_processes or available_cpus(), initializer=_init_parallel_worker, initargs=(scores,))
+            _parallel_pool = (executor, scores, slots)
+        return _parallel_pool
+
+def _discard_parallel_pool(executor):
+    '''Forgets the shared pool if it's still the given (broken) executor, so the next parallel solve makes a new one with new slots'''
+    global _parallel_pool
+    with _parallel_pool_lock:
+        if _parallel_pool is not None and _parallel_pool[0] is executor:
+            logger.warning('Parallel solve pool broke, starting a new one for the next solve')
+            _parallel_pool = None
+    executor.shutdown(wait=False)
+
+def _init_parallel_worker(scores):
+    '''Process pool initializer, keeps the shared best scores for the searches run in this process'''
+    global _shared_scores
+    _shared_scores = scores
+
+def _solve_first_move(grid, targets, buffer_size, first_move, slot, beam_width, table_size, deadline=None, node_budget=None, ordering='index'):
+    '''Runs the optimal search for the sequences starting at the given column of the first row, sharing the best score through the given slot.
+    Returns the sequence, score and stats'''
+    breach = Breacher(grid, targets, buffer_size)
+    seq, score = breach._search(False, beam_width, True, table_size, [first_move], SharedScore(_shared_scores, slot), deadline, node_budget, ordering=ordering)
+    stats = {
+        'total_tested': breach.total_tested,
+        'total_solutions': breach.total_solutions,
+        'total_pruned': breach.total_pruned,
+        'table_hits': breach.table_hits,
+        'table_misses': breach.table_misses,
+        'peak_frontier': breach.peak_frontier,
+        'nodes_expanded': breach.nodes_expanded,
+        'budget_exhausted': breach.budget_exhausted
+    }
+    return seq, score, stats
+
+def board_result(breach, seq, score):
+    '''The JSON friendly result of a solve'''
+    return {
+        'score': score,
+        'sequence': seq,
+        'sequence_text': breach.positions_to_text(seq),
+        'proven_optimal': breach.proven_optimal,
+        'budget_exhausted': breach.budget_exhausted,
+        'total_tested': breach.total_tested
+    }
+
+def _solve_chunk(boards, mode, options):
+    '''Solves a chunk of (key, grid, targets, buffer size) boards in a pool process, returns a list of (key, result).
+    A board that can't be solved gets a result with just an error'''
+    results = []
+    for key, grid, targets, buffer_size in boards:
+        try:
+            breach = Breacher(grid, targets, buffer_size)
+            seq, score = breach.solve(mode=mode, **options)
+            results.append((key, board_result(breach, seq, score)))
+        except Exception as e:
+            results.append((key, {'error': str(e)}))
+    return results
+
+def solve_batch(boards, mode='best_first', workers=None, chunk_size=None, executor=None, **options):
+    '''Solves many (grid, targets, buffer size) boards across a process pool, yielding (index, result) in the order they finish.
+    Identical boards are only solved once, and are sent to the pool in chunks of chunk_size to keep the overhead per board down.
+    By default the chunks are sized to give each of the workers processes about BATCH_CHUNKS_PER_WORKER of them, up to BATCH_CHUNK_SIZE boards.
+    Uses the given executor if there is one (workers should then be its number of processes), otherwise a pool of workers processes just for this batch.
+    The 'parallel' mode runs as 'optimal' (the same result) since the boards are already spread over the processes.
+    Any other keyword options (time_budget, node_budget, ...) are passed on to solve'''
+    if mode == 'parallel': mode = 'optimal'
+    indexes = collections.OrderedDict() # board -> indexes of the inputs that are that board
+    for index, (grid, targets, buffer_size) in enumerate(boards):
+        key = (tuple(tuple(row) for row in grid), tuple(tuple(tgt) for tgt in targets), buffer_size)
+        indexes.setdefault(key, []).append(index)
+    unique = [(i, [list(row) for row in key[0]], [list(tgt) for tgt in key[1]], key[2]) for i, key in enumerate(indexes)]
+    board_indexes = list(indexes.values())
+    if chunk_size is None:
+        chunk_size = min(BATCH_CHUNK_SIZE, max(1, math.ceil(len(unique) / ((workers or available_cpus()) * BATCH_CHUNKS_PER_WORKER))))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers or available_cpus())
+    try:
+        futures = [executor.submit(_solve_chunk, unique[i:i+chunk_size], mode, options) for i in range(0, len(unique), chunk_size)]
+        for future in concurrent.futures.as_completed(futures):
+            for key, result in future.result():
+                for index in board_indexes[key]:
+                    yield index, result
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
 if __name__ == "__main__":
     start = time.perf_counter()
     breach = Breacher()
@@ -170,4 +963,5 @@ if __name__ == "__main__":
     # sequence, score = breach.solve_v2()
     elapsed = time.perf_counter() - start
     print('Solution:', sequence, breach.positions_to_text(sequence), score, elapsed)
-    print('{0} solutions, {1} tested'.format(breach.total_solutions, breach.total_tested))
+    print('{0} solutions, {1} tested, {2} peak open'.format(breach.total_solutions, breach.total_tested, breach.peak_frontier))
+    print('Transposition table: {0} hits, {1} misses'.format(breach.table_hits, breach.table_misses))
@@ -0,0 +1,135 @@
+# This file handles solving a continuous stream of frames (a video file, or a directory of frames standing in for a screen capture)
+#builtin
+import collections
+import logging
+import os
+import time
+
+#pip
+import cv2
+import numpy
+
+#ours
+import image_processing
+from breacher import Breacher
+
+HASH_SIZE = (64, 36) # width, height frames are shrunk to for comparing them
+HASH_STEP = 4 # only every this many pixels are looked at before shrinking
+FRAME_DIFF_LEVEL = 8 # gray levels a pixel of the hash has to change by to count as changed
+FRAME_CHANGED_PIXELS = 2 # a frame with at most this many changed hash pixels counts as unchanged, so a cursor moving doesn't set off a solve
+SOLVED_BOARDS = 32 # recent boards whose solutions are kept, so a board coming back isn't solved again
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+OVERLAY_COLOR = (0, 255, 255)
+
+logger = logging.getLogger(__name__)
+
+def read_frames(source):
+    '''Yields the frames of a video file, or of the images in a directory in name order'''
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                img = image_processing.open_image(os.path.join(source, filename))
+                if img is not None:
+                    yield img
+        return
+    video = cv2.VideoCapture(source)
+    try:
+        while True:
+            ok, img = video.read()
+            if not ok:
+                break
+            yield img
+    finally:
+        video.release()
+
+def frame_hash(img):
+    '''A tiny grayscale copy of the frame, cheap enough to make for every frame'''
+    #nearest neighbour picks out every HASH_STEP pixels without copying the strided view first, which is most of the cost otherwise
+    sampled = cv2.resize(img, (img.shape[1]//HASH_STEP, img.shape[0]//HASH_STEP), interpolation=cv2.INTER_NEAREST)
+    small = cv2.resize(sampled, HASH_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(numpy.int16)
+
+class StreamSolver(object):
+    '''Solves the board in each frame of a stream, doing as little as it can per frame. Frames that look the same as the last one
+    are skipped, the regions found in one frame are reused for the next ones until they stop holding a board,
+    and boards that were already solved recently aren't solved again'''
+    def __init__(self, mode='best_first', shortest=False) -> None:
+        super().__init__()
+        self.mode = mode
+        self.shortest = shortest
+        self.regions = None # threshold and regions from the last full extraction, see image_processing.run_extraction
+        self.last_hash = None
+        self.last_result = None # (sequence, sequence text, score, grid bounds, boxes) for the last frame with a board
+        self.solutions = collections.OrderedDict() # (grid, targets, buffer size) -> (sequence, sequence text, score), most recent last
+        self.frames = 0
+        self.skipped = 0 # frames that looked the same as the one before
+        self.detected = 0 # frames the regions had to be found in
+        self.tracked = 0 # frames the last regions were reused for
+        self.solved = 0
+        self.reused = 0 # boards that had already been solved
+
+    def process(self, img):
+        '''Finds and solves the board in the frame and draws the solution on it.
+        Returns the sequence, sequence text and score, or None if there is no board in the frame'''
+        self.frames += 1
+        frame = frame_hash(img)
+        #a new board changes a lot of small codes, which barely moves the average but changes many pixels of the hash
+        if self.last_hash is not None and numpy.count_nonzero(numpy.abs(frame - self.last_hash) > FRAME_DIFF_LEVEL) <= FRAME_CHANGED_PIXELS:
+            self.skipped += 1
+        else:
+            self.last_hash = frame
+            self.last_result = self._solve_frame(img)
+        if self.last_result is None:
+            return None
+        seq, seq_txt, score, grid_bounds, boxes = self.last_result
+        image_processing.overlay_result(img, seq, boxes, OVERLAY_COLOR, grid_bounds)
+        return seq, seq_txt, score
+
+    def _solve_frame(self, img):
+        grid = None
+        if self.regions is not None:
+            grid, targets, buffer_size, grid_bounds, boxes, _ = image_processing.run_tracked_extraction(img, self.regions)
+            if grid is None:
+                logger.debug('Regions no longer hold a board, finding them again')
+                self.regions = None
+            else:
+                self.tracked += 1
+        if grid is None:
+            regions = {}
+            grid, targets, buffer_size, grid_bounds, boxes, _ = image_processing.run_extraction(img, coarse=True, regions=regions)
+            self.detected += 1
+            if grid is None or not targets or buffer_size == 0:
+                return None
+            self.regions = regions
+
+        key = (tuple(tuple(row) for row in grid), tuple(tuple(tgt) for tgt in targets), buffer_size)
+        solution = self.solutions.get(key)
+        if solution is None:
+            breach = Breacher(grid, targets, buffer_size)
+            seq, score = breach.solve(shortest=self.shortest, mode=self.mode)
+            solution = (seq, breach.positions_to_text(seq), score)
+            logger.info('Solution: %s %s %s', solution[0], solution[1], score)
+            self.solved += 1
+            self.solutions[key] = solution
+            while len(self.solutions) > SOLVED_BOARDS:
+                self.solutions.popitem(last=False)
+        else:
+            self.reused += 1
+            self.solutions.move_to_end(key)
+        return solution + (grid_bounds, boxes)
+
+def run_stream(source, mode='best_first', shortest=False, show=True):
+    '''Solves every frame from the source (see read_frames), showing them with the solution drawn on unless show is False.
+    Stops early if q is pressed in the window. Returns the StreamSolver, which has counts of what was done for the frames'''
+    solver = StreamSolver(mode, shortest)
+    start = time.perf_counter()
+    for img in read_frames(source):
+        solver.process(img)
+        if show:
+            cv2.imshow('breacher', img)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    elapsed = time.perf_counter() - start
+    logger.info('%d frames in %.2fs (%.1f fps): %d skipped, %d detected, %d tracked, %d solved, %d already solved',
+        solver.frames, elapsed, solver.frames / max(elapsed, 1e-9), solver.skipped, solver.detected, solver.tracked, solver.solved, solver.reused)
+    return solver
@@ -0,0 +1,253 @@
+# This file handles benchmarking the extraction pipeline for speed and accuracy against labeled screenshots
+#builtin
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+#pip
+import cv2
+import numpy
+
+#ours
+import image_processing
+from benchmark import percentile
+
+RESOLUTIONS = {'900p': 900, '1080p': 1080, '1440p': 1440, '4k': 2160} # heights, widths keep the screenshot's aspect ratio
+QUALITIES = [None, 95, 75, 50] # JPEG qualities, None leaves the image lossless
+STAGES = ['threshold', 'find_matrix', 'targets', 'buffer', 'grid', 'classify']
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+#synthetic screenshot colors (BGR), roughly the game's
+BACKGROUND_COLOR = (22, 16, 12)
+CODE_COLOR = (90, 235, 205)
+
+def load_corpus(directory):
+    '''Loads the labeled screenshots in the directory. Every image needs a JSON file with the same name holding
+    its 'grid', 'targets' and 'buffer_size', images without one are skipped. Returns a list of (name, image, label)'''
+    samples = []
+    for filename in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(filename)
+        label_path = os.path.join(directory, name + '.json')
+        if ext.lower() not in IMAGE_EXTENSIONS or not os.path.exists(label_path):
+            continue
+        with open(label_path) as f:
+            label = json.load(f)
+        samples.append((name, image_processing.open_image(os.path.join(directory, filename)), label))
+    return samples
+
+def code_glyphs():
+    '''The code images cropped to just the code, as ink strength (0 to 1) for compositing'''
+    glyphs = {}
+    for code, im in image_processing.build_source_codes().items():
+        ys, xs = numpy.where(im < 128) # the codes are dark on white
+        crop = im[ys.min():ys.max()+1, xs.min():xs.max()+1]
+        glyphs[code] = (255 - crop.astype(numpy.float32)) / 255
+    return glyphs
+
+def paste_code(img, glyph, x, y, height):
+    '''Draws the glyph onto the image with its top left corner at x, y, scaled to the given height'''
+    width = max(1, round(glyph.shape[1] * height / glyph.shape[0]))
+    alpha = cv2.resize(glyph, (width, height), interpolation=cv2.INTER_AREA if height < glyph.shape[0] else cv2.INTER_LINEAR)[..., None]
+    area = img[y:y+height, x:x+width].astype(numpy.float32)
+    img[y:y+height, x:x+width] = (area * (1 - alpha) + numpy.array(CODE_COLOR, numpy.float32) * alpha).astype(numpy.uint8)
+    return width
+
+def synthesize_screenshot(grid, targets, buffer_size, width=1920, height=1080, glyphs=None):
+    '''Composites the code images into a screenshot laid out the way run_extraction expects:
+    the code matrix on the left, the targets in the middle and the buffer above them'''
+    if glyphs is None: glyphs = code_glyphs()
+    s = height / 1080
+    line = max(1, round(2 * s))
+    code_height = round(20 * s)
+    img = numpy.empty((height, width, 3), numpy.uint8)
+    img[:] = BACKGROUND_COLOR
+
+    #code matrix, an outlined box with a header, the codes are centered in the part below the header
+    mx, my = int(width * 0.05), int(height * 0.3)
+    mw = int(width * 0.33)
+    mh = int(mw / 1.3)
+    cv2.rectangle(img, (mx, my), (mx + mw, my + mh), CODE_COLOR, line)
+    pitch = int(width * 0.026)
+    top = my + mh // 8
+    left = mx + (mw - pitch * len(grid[0])) // 2
+    top += (mh - 10 - mh // 8 - pitch * len(grid)) // 2
+    for i, row in enumerate(grid):
+        for j, code in enumerate(row):
+            glyph = glyphs[code]
+            code_width = round(glyph.shape[1] * code_height / glyph.shape[0])
+            paste_code(img, glyph, left + j * pitch + (pitch - code_width) // 2, top + i * pitch + (pitch - code_height) // 2, code_height)
+
+    #targets, one row each
+    tx, ty = int(width * 0.44), int(height * 0.35)
+    for i, row in enumerate(targets):
+        for j, code in enumerate(row):
+            paste_code(img, glyphs[code], tx + j * int(width * 0.024), ty + i * int(height * 0.05), code_height)
+
+    #buffer, an outlined box with a pair of vertical lines for every slot
+    bx, by = int(width * 0.45), int(height * 0.17)
+    slot = int(width * 0.022)
+    bh = int(height * 0.05)
+    cv2.rectangle(img, (bx, by), (bx + buffer_size * slot + 2 * slot // 3, by + bh), CODE_COLOR, line)
+    for k in range(buffer_size):
+        for edge in (0.2, 0.8):
+            lx = bx + slot // 3 + int((k + edge) * slot)
+            cv2.line(img, (lx, by + bh // 5), (lx, by + bh - bh // 5), CODE_COLOR, line)
+    return img
+
+def random_label(rng):
+    '''A random board, grid sizes 5 to 8, 1 to 4 targets and buffer sizes 4 to 10'''
+    size = rng.randint(5, 8)
+    return {
+        'grid': [[rng.choice(image_processing.CODES) for _ in range(size)] for _ in range(size)],
+        'targets': [[rng.choice(image_processing.CODES) for _ in range(rng.randint(2, 4))] for _ in range(rng.randint(1, 4))],
+        'buffer_size': rng.randint(4, 10)
+    }
+
+def synthetic_corpus(count, seed=0):
+    '''count synthetic 1080p screenshots with their labels, as a list of (name, image, label)'''
+    rng = random.Random(seed)
+    glyphs = code_glyphs()
+    samples = []
+    for i in range(count):
+        label = random_label(rng)
+        samples.append(('synthetic_{0}'.format(i), synthesize_screenshot(label['grid'], label['targets'], label['buffer_size'], glyphs=glyphs), label))
+    return samples
+
+def write_corpus(samples, directory):
+    '''Saves the samples as a labeled corpus that load_corpus can read back'''
+    os.makedirs(directory, exist_ok=True)
+    for name, img, label in samples:
+        image_processing.save_image(img, os.path.join(directory, name + '.png'))
+        with open(os.path.join(directory, name + '.json'), 'w') as f:
+            json.dump(label, f)
+
+def resize_to(img, height):
+    '''Scales the image to the given height, keeping its aspect ratio'''
+    if img.shape[0] == height:
+        return img
+    width = round(img.shape[1] * height / img.shape[0])
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA if height < img.shape[0] else cv2.INTER_CUBIC)
+
+def jpeg_roundtrip(img, quality):
+    '''The image as it would be after saving as a JPEG with the given quality, unchanged if quality is None'''
+    if quality is None:
+        return img
+    data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+def count_correct(expected, found):
+    '''How many of the expected rows of codes were found in the same place, and how many there were'''
+    correct = 0
+    for i, row in enumerate(expected):
+        for j, code in enumerate(row):
+            if found and i < len(found) and j < len(found[i]) and found[i][j] == code:
+                correct += 1
+    return correct, sum(len(row) for row in expected)
+
+def score_extraction(label, grid, targets, buffer_size):
+    grid_correct, grid_cells = count_correct(label['grid'], grid)
+    target_correct, target_cells = count_correct(label['targets'], targets)
+    return {
+        'found': grid is not None,
+        'grid_correct': grid_correct,
+        'grid_cells': grid_cells,
+        'target_correct': target_correct,
+        'target_cells': target_cells,
+        'buffer_correct': buffer_size == label['buffer_size'],
+        'exact': grid == label['grid'] and targets == label['targets'] and buffer_size == label['buffer_size']
+    }
+
+def measure(img, label, coarse, repeats):
+    '''Runs the extraction repeats times, returns the median time of each stage and the accuracy of the result'''
+    runs = []
+    for _ in range(repeats):
+        timings = {}
+        start = time.perf_counter()
+        grid, targets, buffer_size, _, _, _ = image_processing.run_extraction(img, coarse=coarse, timings=timings)
+        timings['total'] = time.perf_counter() - start
+        runs.append(timings)
+    result = score_extraction(label, grid, targets, buffer_size)
+    result['timings'] = {stage: statistics.median(run[stage] for run in runs) for stage in STAGES + ['total'] if stage in runs[0]}
+    return result
+
+def summarize(results):
+    summary = {'samples': len(results), 'stages': {}}
+    for stage in STAGES + ['total']:
+        times = [r['timings'][stage] for r in results if stage in r['timings']]
+        if times:
+            summary['stages'][stage] = {'median': statistics.median(times), 'p95': percentile(times, 95)}
+    grid_cells = sum(r['grid_cells'] for r in results)
+    target_cells = sum(r['target_cells'] for r in results)
+    summary['found_rate'] = sum(r['found'] for r in results) / len(results)
+    summary['grid_accuracy'] = sum(r['grid_correct'] for r in results) / grid_cells if grid_cells else 0.0
+    summary['target_accuracy'] = sum(r['target_correct'] for r in results) / target_cells if target_cells else 0.0
+    summary['buffer_accuracy'] = sum(r['buffer_correct'] for r in results) / len(results)
+    summary['exact_rate'] = sum(r['exact'] for r in results) / len(results)
+    return summary
+
+def run_harness(samples, resolutions=list(RESOLUTIONS), qualities=QUALITIES, coarse=True, repeats=1, verbose=True):
+    '''Runs every sample through the extraction at every resolution and JPEG quality.
+    Returns the per sample results and a summary (stage latencies, accuracies) for each resolution and quality'''
+    image_processing.get_code_templates() #not part of any timing
+    results = {
+        'meta': {'samples': len(samples), 'coarse': coarse, 'repeats': repeats, 'timestamp': time.time()},
+        'summary': {},
+        'runs': {}
+    }
+    for resolution in resolutions:
+        for quality in qualities:
+            key = '{0}_{1}'.format(resolution, 'q{0}'.format(quality) if quality is not None else 'lossless')
+            runs = []
+            for name, img, label in samples:
+                run = measure(jpeg_roundtrip(resize_to(img, RESOLUTIONS[resolution]), quality), label, coarse, repeats)
+                run['name'] = name
+                runs.append(run)
+            results['runs'][key] = runs
+            results['summary'][key] = summarize(runs)
+            if verbose:
+                summary = results['summary'][key]
+                print('{0:<16} total {1:.4f}s (p95 {2:.4f}s), grid {3:.1%}, targets {4:.1%}, buffer {5:.1%}, exact {6:.1%}'.format(
+                    key, summary['stages']['total']['median'], summary['stages']['total']['p95'],
+                    summary['grid_accuracy'], summary['target_accuracy'], summary['buffer_accuracy'], summary['exact_rate']))
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the extraction speed and accuracy on labeled screenshots.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the harness and write the results as JSON')
+    run_parser.add_argument('corpus', nargs='?', help='directory of labeled screenshots, synthetic ones are used if left out')
+    run_parser.add_argument('-o', '--output', default='extraction_benchmark.json')
+    run_parser.add_argument('--synthetic', type=int, default=10, help='how many synthetic screenshots to use without a corpus')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    run_parser.add_argument('--qualities', nargs='+', type=int, help='JPEG qualities, lossless is always included')
+    run_parser.add_argument('--full', action='store_true', help='threshold the whole image instead of coarse-to-fine')
+    run_parser.add_argument('--repeats', type=int, default=1)
+
+    synth_parser = commands.add_parser('synth', help='write a labeled corpus of synthetic screenshots')
+    synth_parser.add_argument('directory')
+    synth_parser.add_argument('--count', type=int, default=10)
+    synth_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.command == 'synth':
+        write_corpus(synthetic_corpus(args.count, args.seed), args.directory)
+        return 0
+
+    samples = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic, args.seed)
+    if not samples:
+        print('No labeled screenshots found')
+        return 1
+    qualities = QUALITIES if args.qualities is None else [None] + args.qualities
+    results = run_harness(samples, args.resolutions, qualities, not args.full, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
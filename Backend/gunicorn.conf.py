@@ -0,0 +1,26 @@
+# This file handles configuring gunicorn, the production server: gunicorn -c gunicorn.conf.py webapi:app
+#builtin
+import os
+import tempfile
+
+#ours
+from breacher import available_cpus
+
+DEFAULT_WORKERS = 4
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '5000')
+#each worker's solver pools get an even share of the pod's CPUs (see webapi.solver_processes), so a few workers are enough to keep them busy
+workers = int(os.environ.get('BREACHER_WORKERS', min(DEFAULT_WORKERS, available_cpus())))
+os.environ['BREACHER_WORKERS'] = str(workers)
+threads = int(os.environ.get('BREACHER_THREADS', 4)) #so streamed solves and job long-polls don't hold up a whole worker
+timeout = int(os.environ.get('BREACHER_WORKER_TIMEOUT', 120)) #seconds, solves can be long
+preload_app = True #import webapi and warm up once in the master, the workers share it all copy-on-write
+accesslog = None #requests are already counted in /metrics
+
+#every worker writes its metrics here so /metrics reports the totals no matter which worker answers it
+if 'BREACHER_METRICS_DIR' not in os.environ:
+    os.environ['BREACHER_METRICS_DIR'] = tempfile.mkdtemp(prefix='breacher-metrics-')
+
+#jobs are kept here so polling or cancelling one works no matter which worker answers it
+if 'BREACHER_JOB_DB' not in os.environ:
+    os.environ['BREACHER_JOB_DB'] = os.path.join(tempfile.mkdtemp(prefix='breacher-jobs-'), 'jobs.sqlite')
@@ -3,23 +3,31 @@
 import math
 import time
 import base64
+import logging
 import os
 
 #pip
 import cv2
-import imutils
 import numpy
-from skimage.metrics import structural_similarity
 
 #ours
+import log_config
 from breacher import Breacher
 
+CODES = ['1C', '7A', '55', 'BD', 'E9', 'FF']
+TEMPLATE_SIZE = (36, 30) # width, height that the code images and regions are resized to before comparing
+UNCERTAIN_CONFIDENCE = 0.6 # codes matched with less confidence than this are flagged as uncertain
+COARSE_WIDTH = 960 # in coarse mode the regions are found on a copy downscaled to about this wide
+
+_code_templates = None # loaded on first use, see get_code_templates
+
+logger = logging.getLogger(__name__)
+
 def build_source_codes():
     '''Reads in the code images for later compariosn'''
     images = {} # clear it out just in case
-    codes = ['1C', '7A', '55', 'BD', 'E9', 'FF']
 
-    for code in codes:
+    for code in CODES:
         fp = 'codes/{0}.png'.format(code)
         if not os.path.exists(fp):
             fp = 'Backend/' + fp
@@ -28,184 +36,300 @@ def build_source_codes():
     
     return images
 
-def determine_code(region, code_images, extra_pad = 0):
-    '''Determine which code is in the provided region by comparing images. Optional extra padding around the region, taking the resizing into account'''
-    closest_code = None
-    closest_score = -1
-    for code in code_images: #infinitely faster than doing OCR with tesseract (<0.1s vs 5s)
-        code_im = code_images[code]
-        region_resized = cv2.resize(region, (code_im.shape[1]-2*extra_pad, code_im.shape[0]-2*extra_pad))
-        if extra_pad != 0:
-            region_resized = cv2.copyMakeBorder(region_resized, extra_pad, extra_pad, extra_pad, extra_pad, cv2.BORDER_CONSTANT, value=(255, 255, 255))
-        (score, _) = structural_similarity(region_resized, code_im, full=True)
-        if score > closest_score:
-            closest_score = score
-            closest_code = code
-    return closest_code
-    
+def prepare_code_templates(code_images):
+    '''Resizes the code images to the template size and stacks them, normalized, as the rows of a matrix. Returns the codes and the matrix'''
+    codes = list(code_images)
+    stack = numpy.empty((len(codes), TEMPLATE_SIZE[0]*TEMPLATE_SIZE[1]), numpy.float32)
+    for i in range(len(codes)):
+        stack[i] = cv2.resize(code_images[codes[i]], TEMPLATE_SIZE).ravel()
+    return codes, normalize_rows(stack)
+
+def get_code_templates():
+    '''The prepared code templates, only read from disk the first time'''
+    global _code_templates
+    if _code_templates is None:
+        _code_templates = prepare_code_templates(build_source_codes())
+    return _code_templates
+
+def normalize_rows(stack):
+    '''Makes every row zero mean and unit length, so the dot product of two rows is their normalized cross-correlation'''
+    stack = stack - stack.mean(axis=1, keepdims=True)
+    norms = numpy.linalg.norm(stack, axis=1, keepdims=True)
+    norms[norms == 0] = 1 # blank regions just score 0 against everything
+    return stack / norms
+
+def classify_regions(regions, code_templates=None, extra_pad = 0):
+    '''Determine which code is in each of the provided regions by comparing them all against all of the templates at once.
+    Optional extra padding around the regions (one value for all, or a list with one per region), taking the resizing into account.
+    Returns the codes and the confidence in each one (the normalized cross-correlation with the chosen template, 1 is a perfect match)'''
+    if not regions: return [], []
+    if code_templates is None: code_templates = get_code_templates()
+    codes, template_matrix = code_templates
+    pads = extra_pad if isinstance(extra_pad, (list, tuple)) else [extra_pad] * len(regions)
+    batch = numpy.empty((len(regions), TEMPLATE_SIZE[1], TEMPLATE_SIZE[0]), numpy.uint8)
+    for i in range(len(regions)): #infinitely faster than doing OCR with tesseract (<0.1s vs 5s)
+        pad = pads[i]
+        if pad != 0:
+            batch[i] = 255 # white border around the resized region
+        batch[i, pad:TEMPLATE_SIZE[1]-pad, pad:TEMPLATE_SIZE[0]-pad] = cv2.resize(regions[i], (TEMPLATE_SIZE[0]-2*pad, TEMPLATE_SIZE[1]-2*pad))
+    scores = normalize_rows(batch.reshape(len(regions), -1).astype(numpy.float32)) @ template_matrix.T
+    best = scores.argmax(axis=1)
+    confidences = scores[numpy.arange(len(regions)), best]
+    return [codes[i] for i in best], [round(float(c), 3) for c in confidences]
+
+def find_uncertain(confidences, threshold=UNCERTAIN_CONFIDENCE):
+    '''Returns the [row, column] of every code in the rows of confidences that is below the threshold'''
+    return [[i, j] for i in range(len(confidences)) for j in range(len(confidences[i])) if confidences[i][j] < threshold]
+
+def matrix_roi_bounds(shape):
+    '''The part of an image with the given shape that the code matrix is searched for in, as [(x start, x end), (y start, y end)]'''
+    return [(0, int(shape[1]/2)), (int(shape[0]*0.25), int(shape[0]*0.9))] # this is in width, height
+
+def component_boxes(binary):
+    '''The bounding boxes of the outermost white shapes in a binary image, as an N x 4 array of x, y, w, h.
+    Only their outlines are traced, which is much quicker than labelling every pixel with connectedComponentsWithStats'''
+    cnts = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2] #the contours are the second to last result in every opencv version
+    if not cnts:
+        return numpy.empty((0, 4), numpy.int64)
+    return numpy.array([cv2.boundingRect(c) for c in cnts], numpy.int64)
+
+def cluster_positions(values, gap):
+    '''Clusters positions along one axis, a new cluster starts wherever the sorted positions jump by more than gap.
+    Returns the cluster of each position (numbered from the lowest positions up) and how many clusters there are'''
+    if len(values) == 0:
+        return numpy.empty(0, numpy.int64), 0
+    order = numpy.argsort(values, kind='stable')
+    labels = numpy.empty(len(values), numpy.int64)
+    labels[order] = numpy.concatenate(([0], numpy.cumsum(numpy.diff(values[order]) > gap)))
+    return labels, int(labels.max()) + 1
+
+def group_codes(boxes, code_gap):
+    '''Joins the character boxes of each code into one box. Characters are put in lines by clustering their vertical centers,
+    then characters on a line less than code_gap apart horizontally are joined, like closing the image with a kernel that size would.
+    Returns the code boxes as an N x 4 array of x, y, w, h'''
+    if len(boxes) == 0:
+        return boxes
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+    lines, _ = cluster_positions(y0 + boxes[:, 3] / 2, numpy.median(boxes[:, 3]) / 2)
+    labels = numpy.empty(len(boxes), numpy.int64)
+    group = -1
+    line = reach = None
+    for i in numpy.lexsort((x0, lines)): #left to right along each line
+        if lines[i] != line or x0[i] > reach + code_gap:
+            group += 1
+            line = lines[i]
+            reach = x1[i]
+        labels[i] = group
+        reach = max(reach, x1[i])
+    count = group + 1
+    left = numpy.full(count, numpy.iinfo(numpy.int64).max)
+    top = numpy.full(count, numpy.iinfo(numpy.int64).max)
+    right = numpy.zeros(count, numpy.int64)
+    bottom = numpy.zeros(count, numpy.int64)
+    numpy.minimum.at(left, labels, x0)
+    numpy.minimum.at(top, labels, y0)
+    numpy.maximum.at(right, labels, x1)
+    numpy.maximum.at(bottom, labels, y1)
+    return numpy.stack([left, top, right - left, bottom - top], axis=1)
+
+def find_code_matrix_bounds(img_thresh, scale=1):
+    '''Finds the code matrix in the thresholded image, returns its bounds (x,y,w,h) or None.
+    If the image is downscaled then scale is how many times smaller it is, the bounds are still in full resolution coordinates'''
+    roi_1_bounds = matrix_roi_bounds(img_thresh.shape)
+    left_half = img_thresh[roi_1_bounds[1][0]:roi_1_bounds[1][1], roi_1_bounds[0][0]:roi_1_bounds[0][1]]
+    # cv2.imshow('img_left', left_half)
+
+    boxes = component_boxes(left_half)
+    w, h = boxes[:, 2], boxes[:, 3]
+    ratio = w / h
+    candidates = numpy.flatnonzero((ratio > 1.1) & (ratio < 1.5) & (w*scale > 400) & (h*scale > 300)) #must be roughly 1.4 aspect ratio and minimum of 300 pixels
+    if len(candidates) == 0:
+        return None
+    (x, y, w, h) = (int(v) for v in boxes[candidates[numpy.argmax(w[candidates] * h[candidates])]]) #the biggest if there's more than one
+    x = (x + roi_1_bounds[0][0]) * scale
+    y = (y + roi_1_bounds[1][0]) * scale
+    w *= scale
+    h *= scale
+    return (x+10, y+int(h/8), w-20, h-10-int(h/8))
 
 def find_code_matrix(img_thresh, img=None):
     '''Finds the code matrix in the image, returns the roi and its bounds (x,y,w,h) within the source image'''
-    roi_1_bounds = [(0, int(img_thresh.shape[1]/2)), (int(img_thresh.shape[0]*0.25), int(img_thresh.shape[0]*0.9))] # this is in width, height
-    left_half = img_thresh[roi_1_bounds[1][0]:roi_1_bounds[1][1], roi_1_bounds[0][0]:roi_1_bounds[0][1]]
-    # cv2.imshow('img_left', left_half)
     grid_box = None
-    bounds = (0, 0, 0, 0)
-
-    cnts = cv2.findContours(left_half.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = imutils.grab_contours(cnts)
-    for c in cnts:
-        (x, y, w, h) = cv2.boundingRect(c)
-        ratio = w/h
-        x += roi_1_bounds[0][0]
-        y += roi_1_bounds[1][0]
-        if ratio > 1.1 and ratio < 1.5 and w > 400 and h > 300: #must be roughly 1.4 aspect ratio and minimum of 300 pixels
-            bounds = (x+10, y+int(h/8), w-20, h-10-int(h/8))
-            grid_box = img_thresh[bounds[1]:bounds[1]+bounds[3], bounds[0]:bounds[0]+bounds[2]]
-            if img is not None:
-                cv2.rectangle(img, (bounds[0], bounds[1]), (bounds[0]+bounds[2], bounds[1]+bounds[3]), (255, 0, 0), 2)
-            break
+    bounds = find_code_matrix_bounds(img_thresh)
+    if bounds is None:
+        return grid_box, (0, 0, 0, 0)
+
+    grid_box = img_thresh[bounds[1]:bounds[1]+bounds[3], bounds[0]:bounds[0]+bounds[2]]
+    if img is not None:
+        cv2.rectangle(img, (bounds[0], bounds[1]), (bounds[0]+bounds[2], bounds[1]+bounds[3]), (255, 0, 0), 2)
 
     return grid_box, bounds
 
-def extract_grid(grid_box, grid_bounds, code_images, img=None):
-    '''Extract the code snippets from the (thresholded) region of interest. Original image just used for tagging.'''
+def find_grid_regions(grid_box, grid_bounds, img=None):
+    '''Finds the code regions in the (thresholded) region of interest. Original image just used for tagging.
+    The rows and columns come from clustering the centers of the codes, so the grid doesn't have to be square or complete.
+    Returns the regions, the (row, column) of each region, and the boxes of every cell in rows (estimated for cells no code was found in)'''
     pad = 5
-    #find the code regions by making the codes a blob then finding those contours
-    grid_box_copy = cv2.morphologyEx(grid_box, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (13,13)));
-    cnts = cv2.findContours(grid_box_copy, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = imutils.grab_contours(cnts)
-    grid_raw = []
-    grid_boxes = []
-    for c in cnts: #starts in bottom right, goes right to left
-        (x, y, w, h) = cv2.boundingRect(c)
-        ratio = w/h
-        if ratio > 1.0 and ratio < 1.7 and h > 15:
-            # grab the number region, pad it, compare it
-            region = grid_box[y-pad:y+h+pad, x-pad:x+w+pad]
-            region = cv2.bitwise_not(region)
-            if region is None: continue
-
-            #for any new codes
-            # cv2.imwrite(f'numbers/{x}{y}.png', region)
-            text = determine_code(region, code_images)
-
-            grid_raw.append(text)
-            # x += grid_bounds[0]
-            # y += grid_bounds[1]
-            grid_boxes.append((x, y, w, h)) #in original image coordinates, not roi coords
-            if img is not None:
-                x2 = x + grid_bounds[0]
-                y2 = y + grid_bounds[1]
-                cv2.rectangle(img, (x2-pad, y2-pad), (x2+w+pad, y2+h+pad), (255, 255, 0), 2) #display a box around it
-    grid_raw.reverse()
-    grid_boxes.reverse()
-    
-    grid_size = math.sqrt(len(grid_raw))
-    if math.floor(grid_size) != math.ceil(grid_size):
-        print('Warning! Invalid data, non-square grid detected.')
-    grid_size = round(grid_size)
-    print('Found {0} items in grid. Grid size {1}'.format(len(grid_raw), grid_size))
-    grid_square = []
-    grid_boxes_square = []
-    for i in range(grid_size):
-        row = []
-        row_boxes = []
-        for j in range(grid_size):
-            row.append(grid_raw[i*grid_size + j])
-            row_boxes.append(grid_boxes[i*grid_size + j])
-        grid_square.append(row)
-        grid_boxes_square.append(row_boxes)
-    return grid_square, grid_boxes_square
-
-def extract_targets(img_thresh, code_images, img=None):
+    boxes = group_codes(component_boxes(grid_box), 13) #the two characters of a code are closer than this, separate codes are further apart
+    w, h = boxes[:, 2], boxes[:, 3]
+    ratio = w / numpy.maximum(h, 1)
+    boxes = boxes[(ratio > 1.0) & (ratio < 1.7) & (h > 15)]
+    if len(boxes) == 0:
+        logger.warning('No codes found in grid.')
+        return [], [], []
+
+    code_w, code_h = numpy.median(boxes[:, 2]), numpy.median(boxes[:, 3])
+    rows, row_count = cluster_positions(boxes[:, 1] + boxes[:, 3] / 2, code_h / 2)
+    cols, col_count = cluster_positions(boxes[:, 0] + boxes[:, 2] / 2, code_w / 2)
+    #cells without a code get a box lined up with the rest of their row and column
+    row_tops = [int(numpy.median(boxes[rows == r, 1])) for r in range(row_count)]
+    col_lefts = [int(numpy.median(boxes[cols == c, 0])) for c in range(col_count)]
+    grid_boxes = [[(col_lefts[c], row_tops[r], int(code_w), int(code_h)) for c in range(col_count)] for r in range(row_count)]
+
+    regions = []
+    cells = []
+    for i in numpy.lexsort((cols, rows)): #row by row
+        cell = (int(rows[i]), int(cols[i]))
+        if cells and cells[-1] == cell:
+            continue #two codes in one cell, the first one found wins
+        (x, y, w, h) = (int(v) for v in boxes[i])
+        # grab the number region and pad it, they all get compared at once later
+        region = grid_box[max(0, y-pad):y+h+pad, max(0, x-pad):x+w+pad]
+        region = cv2.bitwise_not(region)
+
+        #for any new codes
+        # cv2.imwrite(f'numbers/{x}{y}.png', region)
+        regions.append(region)
+        cells.append(cell)
+        grid_boxes[cell[0]][cell[1]] = (x, y, w, h) #in roi coords, not original image coordinates
+        if img is not None:
+            x2 = x + grid_bounds[0]
+            y2 = y + grid_bounds[1]
+            cv2.rectangle(img, (x2-pad, y2-pad), (x2+w+pad, y2+h+pad), (255, 255, 0), 2) #display a box around it
+
+    missing = row_count * col_count - len(cells)
+    if missing:
+        logger.warning('%d of the %dx%d grid cells have no code.', missing, row_count, col_count)
+    logger.debug('Found %d items in grid. Grid size %dx%d', len(regions), row_count, col_count)
+    return regions, cells, grid_boxes
+
+def fill_grid(values, cells, grid_boxes, empty):
+    '''Puts the value for each (row, column) in cells into a grid the shape of grid_boxes, cells without a value get empty'''
+    grid = [[empty] * len(row) for row in grid_boxes]
+    for value, (row, col) in zip(values, cells):
+        grid[row][col] = value
+    return grid
+
+def extract_grid(grid_box, grid_bounds, code_templates=None, img=None):
+    '''Extract the code snippets from the (thresholded) region of interest. Original image just used for tagging.
+    Cells with no code are left as '', which the solver treats as already used'''
+    regions, cells, grid_boxes = find_grid_regions(grid_box, grid_bounds, img)
+    grid_raw, _ = classify_regions(regions, code_templates)
+    return fill_grid(grid_raw, cells, grid_boxes, ''), grid_boxes
+
+def target_roi_bounds(shape):
+    '''The part of an image with the given shape that holds the targets, as [(x start, x end), (y start, y end)]'''
+    return [(int(shape[1]*0.4), (int(shape[1]*0.65))), (int(shape[0]*0.3), int(shape[0]*0.75))] # this is in width, height
+
+def find_target_regions(img_thresh, img=None):
+    '''Finds the regions of the target codes, returns them as a list of rows'''
     pad = 5
     targets = []
     
-    roi_bounds = [(int(img_thresh.shape[1]*0.4), (int(img_thresh.shape[1]*0.65))), (int(img_thresh.shape[0]*0.3), int(img_thresh.shape[0]*0.75))] # this is in width, height
+    roi_bounds = target_roi_bounds(img_thresh.shape)
     roi = img_thresh[roi_bounds[1][0]:roi_bounds[1][1], roi_bounds[0][0]:roi_bounds[0][1]]
     # cv2.imshow('roi', roi)
 
-    closing_size = 5
-    if img_thresh.shape[1] > 1600: closing_size = 7 #1600x900
-    if img_thresh.shape[1] > 1920: closing_size = 9 #1920x1080
-    roi_closed = cv2.morphologyEx(roi, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (closing_size, closing_size)))
-    # cv2.imshow('roi', roi_closed)
-    cnts = cv2.findContours(roi_closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = imutils.grab_contours(cnts)
-    current_row = []
-    cur_y = -1
-    for c in cnts: #this goes from bottom right to top left
-        (x, y, w, h) = cv2.boundingRect(c)
-        ratio = w/h
-        if ratio > 1.1 and ratio < 1.7 and w < 100 and w > 10: #must be roughly 1.5 aspect ratio and max of 100 pixels wide
-            if cur_y < 0 : cur_y = y
-            if y < cur_y - 10:
-                #new row
-                current_row.reverse()
-                targets.append(current_row)
-                current_row = []
-                cur_y = y
-            region = roi[y:y+h, x:x+w]
-            region = cv2.bitwise_not(region)
-            text = determine_code(region, code_images, pad)
-            current_row.append(text)
-            x += roi_bounds[0][0]
-            y += roi_bounds[1][0]
-            if img is not None:
-                cv2.rectangle(img, (x-pad, y-pad), (x+w+pad, y+h+pad), (255, 255, 0), 2) #display a box around it
-    if current_row:
-        current_row.reverse()
-        targets.append(current_row)
-    targets.reverse()
-    print('Targets:')
-    for row in targets:
-        print(' '.join(row))
+    code_gap = 5
+    if img_thresh.shape[1] > 1600: code_gap = 7 #1600x900
+    if img_thresh.shape[1] > 1920: code_gap = 9 #1920x1080
+    boxes = group_codes(component_boxes(roi), code_gap)
+    w, h = boxes[:, 2], boxes[:, 3]
+    ratio = w / numpy.maximum(h, 1)
+    boxes = boxes[(ratio > 1.1) & (ratio < 1.7) & (w < 100) & (w > 10)] #must be roughly 1.5 aspect ratio and max of 100 pixels wide
+    if len(boxes) == 0:
+        return targets
+
+    rows, row_count = cluster_positions(boxes[:, 1] + boxes[:, 3] / 2, numpy.median(boxes[:, 3]) / 2)
+    targets = [[] for _ in range(row_count)]
+    for i in numpy.lexsort((boxes[:, 0], rows)): #top to bottom, left to right
+        (x, y, w, h) = (int(v) for v in boxes[i])
+        region = roi[y:y+h, x:x+w]
+        region = cv2.bitwise_not(region)
+        targets[rows[i]].append(region)
+        x += roi_bounds[0][0]
+        y += roi_bounds[1][0]
+        if img is not None:
+            cv2.rectangle(img, (x-pad, y-pad), (x+w+pad, y+h+pad), (255, 255, 0), 2) #display a box around it
+    return targets
+
+def format_rows(rows):
+    '''Rows of codes as text, one line per row'''
+    return '\n'.join(' '.join(row) for row in rows)
+
+def split_rows(items, rows):
+    '''Splits a flat list back into rows the same lengths as the given ones'''
+    split = []
+    for row in rows:
+        split.append(items[:len(row)])
+        items = items[len(row):]
+    return split
+
+def extract_targets(img_thresh, code_templates=None, img=None):
+    pad = 5
+    target_regions = find_target_regions(img_thresh, img)
+    texts, _ = classify_regions([region for row in target_regions for region in row], code_templates, pad)
+    targets = split_rows(texts, target_regions)
+    if logger.isEnabledFor(logging.DEBUG): #don't build the text unless it's going to be logged
+        logger.debug('Targets:\n%s', format_rows(targets))
     return targets
 
+def buffer_roi_bounds(shape):
+    '''The part of an image with the given shape that holds the buffer, as [(x start, x end), (y start, y end)]'''
+    return [(int(shape[1]*0.42), (int(shape[1]*0.8))), (int(shape[0]*0.15), int(shape[0]*0.25))] # this is in width, height
+
 def find_buffer_region(img_thresh, img=None):
     '''Finds the buffer region, returns the bounds (x,y,w,h) but not the image.'''
-    roi_bounds = [(int(img_thresh.shape[1]*0.42), (int(img_thresh.shape[1]*0.8))), (int(img_thresh.shape[0]*0.15), int(img_thresh.shape[0]*0.25))] # this is in width, height
+    roi_bounds = buffer_roi_bounds(img_thresh.shape)
     roi = img_thresh[roi_bounds[1][0]:roi_bounds[1][1], roi_bounds[0][0]:roi_bounds[0][1]]
 
-    buffer_bounds = (0,0,0,0)
-
-    cnts = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = imutils.grab_contours(cnts)
-    for c in cnts: #this goes from bottom right to top left
-        (x, y, w, h) = cv2.boundingRect(c)
-        ratio = w/h
-        if ratio > 1 and h > 10:
-            x += roi_bounds[0][0]
-            y += roi_bounds[1][0]
-            buffer_bounds = (x, y, w, h)
-            if img is not None:        
-                cv2.rectangle(img, (x, y), (x+w, y+h), (255, 0, 0), 2) #display a box around it
-            break
-    return buffer_bounds
+    boxes = component_boxes(roi)
+    w, h = boxes[:, 2], boxes[:, 3]
+    candidates = numpy.flatnonzero((w > h) & (h > 10))
+    if len(candidates) == 0:
+        return (0,0,0,0)
+    (x, y, w, h) = (int(v) for v in boxes[candidates[numpy.argmax(w[candidates] * h[candidates])]]) #the biggest if there's more than one
+    x += roi_bounds[0][0]
+    y += roi_bounds[1][0]
+    if img is not None:        
+        cv2.rectangle(img, (x, y), (x+w, y+h), (255, 0, 0), 2) #display a box around it
+    return (x, y, w, h)
 
 def extract_buffer(img_gray, buffer_bounds, img=None):
     '''Determines the buffer size. Takes the gray image, not the thresholded one (we re-threshold just the region)'''
-    buffer_size = 0
     pad = 5
-    verticals = 0
     roi = img_gray[buffer_bounds[1]+pad:buffer_bounds[1]+buffer_bounds[3]-pad, buffer_bounds[0]+pad:buffer_bounds[0]+buffer_bounds[2]-pad]
+    if roi.size == 0:
+        return 0
     roi = cv2.threshold(roi, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1] # we threshold just the buffer region
 
-    cnts = cv2.findContours(roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = imutils.grab_contours(cnts)
-    for c in cnts: #this goes from bottom right to top left
-        (x, y, w, h) = cv2.boundingRect(c)
-        ratio = w/h
-        if ratio < 0.3: #basically vertical line
-            verticals += 1
-            if img is not None:
-                x += buffer_bounds[0]+pad
-                y += buffer_bounds[1]+pad
-                cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 255), 2) #display a box around it
-
-    buffer_size = math.ceil(verticals / 2) #two verticals per buffer block
-    return buffer_size
+    #every component, not just the outermost ones, so lines inside what's left of the box's border still count. The region is small enough that labelling it is cheap
+    boxes = cv2.connectedComponentsWithStats(roi, connectivity=8)[2][1:, :4]
+    verticals = boxes[boxes[:, 2] < 0.3 * boxes[:, 3]] #basically vertical lines
+    if img is not None:
+        for (x, y, w, h) in verticals.tolist():
+            x += buffer_bounds[0]+pad
+            y += buffer_bounds[1]+pad
+            cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 255), 2) #display a box around it
+
+    return math.ceil(len(verticals) / 2) #two verticals per buffer block
+
+def buffer_unchanged(img_thresh, buffer_bounds):
+    '''Whether the buffer box still ends where the bounds do, with its edge in their last column and nothing in the gap past them.
+    A bigger or smaller buffer moves the edge, so the bounds have to be found again'''
+    (x, y, w, h) = buffer_bounds
+    return img_thresh[y:y+h, x+w-1].any() and not img_thresh[y:y+h, x+w:x+w+h//2].any()
 
 def overlay_result(img, sequence, box_positions, color, grid_bounds=(0,0,0,0), offset_x=0, offset_y=0):
     '''Draws lines on the original image showing the solved pattern'''
@@ -219,40 +343,163 @@ def overlay_result(img, sequence, box_positions, color, grid_bounds=(0,0,0,0), o
         cv2.arrowedLine(img, first, second, color, 2)
 
 
-def run_extraction(img, show_debug_markers=False):
-    '''Runs the extraction steps, returning the grid, targets list, buffer size, matrix region coords and matrix code positions (for overlay)'''
-    code_images = build_source_codes()
+def choose_coarse_scale(width):
+    '''How many times to downscale an image of the given width for the coarse pass, 1 if it's small enough already'''
+    scale = 1
+    while scale < 8 and width / (scale*2) >= COARSE_WIDTH:
+        scale *= 2
+    return scale
+
+def bounds_roi(bounds):
+    '''Bounds (x,y,w,h) as [(x start, x end), (y start, y end)]'''
+    return [(bounds[0], bounds[0]+bounds[2]), (bounds[1], bounds[1]+bounds[3])]
+
+def threshold_regions(img, rois, threshold):
+    '''Converts and thresholds just the given regions ([(x start, x end), (y start, y end)] each) of the image.
+    Returns the gray and thresholded images, which are zero outside those regions'''
+    img_gray = numpy.zeros(img.shape[:2], numpy.uint8)
+    img_thresh = numpy.zeros(img.shape[:2], numpy.uint8)
+    for roi in rois:
+        (x0, x1), (y0, y1) = roi
+        img_gray[y0:y1, x0:x1] = cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        img_thresh[y0:y1, x0:x1] = cv2.threshold(img_gray[y0:y1, x0:x1], threshold, 255, cv2.THRESH_BINARY)[1]
+    return img_gray, img_thresh
+
+def threshold_coarse(img, scale):
+    '''Coarse-to-fine thresholding. The Otsu threshold and the code matrix are found on a downscaled copy,
+    then only the matrix, target and buffer regions are converted and thresholded at full resolution.
+    Returns the gray and thresholded images (zero outside those regions), the matrix bounds and the threshold, or None if the matrix wasn't found'''
+    #nearest neighbour only reads every scale-th pixel, area averaging the full colour frame costs as much as thresholding all of it.
+    #The codes are big and flat enough that the Otsu threshold and the matrix bounds come out the same from the samples
+    coarse = cv2.resize(img, (img.shape[1]//scale, img.shape[0]//scale), interpolation=cv2.INTER_NEAREST)
+    coarse_gray = cv2.cvtColor(coarse, cv2.COLOR_BGR2GRAY)
+    threshold, coarse_thresh = cv2.threshold(coarse_gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    grid_bounds = find_code_matrix_bounds(coarse_thresh, img.shape[1] / coarse_gray.shape[1])
+    if grid_bounds is None:
+        return None, None, None, None
+    grid_bounds = tuple(int(v) for v in grid_bounds)
+
+    img_gray, img_thresh = threshold_regions(img, [bounds_roi(grid_bounds), target_roi_bounds(img.shape), buffer_roi_bounds(img.shape)], threshold)
+    return img_gray, img_thresh, grid_bounds, threshold
+
+def lap(timings, stage, start):
+    '''Records the time since start as the given stage, if timings is a dict. Returns the current time to start the next stage from'''
+    now = time.perf_counter()
+    if timings is not None: timings[stage] = now - start
+    return now
+
+def classify_board(grid_regions, cells, boxes, target_regions, code_templates):
+    '''Classifies every grid and target code in one go (the targets have a bit of extra padding).
+    Returns the grid, the targets and the confidence in each code (as a dict with 'grid' and 'targets')'''
+    target_regions_flat = [region for row in target_regions for region in row]
+    pads = [0] * len(grid_regions) + [5] * len(target_regions_flat)
+    codes, confidences = classify_regions(grid_regions + target_regions_flat, code_templates, pads)
+    grid = fill_grid(codes[:len(grid_regions)], cells, boxes, '')
+    targets = split_rows(codes[len(grid_regions):], target_regions)
+    confidence = {
+        'grid': fill_grid(confidences[:len(grid_regions)], cells, boxes, 0.0),
+        'targets': split_rows(confidences[len(grid_regions):], target_regions)
+    }
+    return grid, targets, confidence
+
+def run_extraction(img, show_debug_markers=False, coarse=False, timings=None, regions=None):
+    '''Runs the extraction steps, returning the grid, targets list, buffer size, matrix region coords, matrix code positions (for overlay)
+    and the confidence in each grid and target code (as a dict with 'grid' and 'targets').
+    With coarse the regions are found on a downscaled image first and only they are thresholded at full resolution. Per stage timings (seconds) are put in timings if it's a dict.
+    If regions is a dict the threshold and the regions that were found are put in it, for run_tracked_extraction to reuse on the next frame'''
+    code_templates = get_code_templates()
 
     debug_image = None
     if show_debug_markers: 
         debug_image = img
 
-    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    img_thresh = cv2.threshold(img_gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-
-    grid_box, grid_bounds = find_code_matrix(img_thresh, debug_image)
+    stage_start = time.perf_counter()
+    scale = choose_coarse_scale(img.shape[1]) if coarse else 1
+    if scale > 1:
+        img_gray, img_thresh, grid_bounds, threshold = threshold_coarse(img, scale)
+        stage_start = lap(timings, 'threshold', stage_start)
+        grid_box = None
+        if grid_bounds is not None:
+            grid_box = img_thresh[grid_bounds[1]:grid_bounds[1]+grid_bounds[3], grid_bounds[0]:grid_bounds[0]+grid_bounds[2]]
+            if debug_image is not None:
+                cv2.rectangle(debug_image, (grid_bounds[0], grid_bounds[1]), (grid_bounds[0]+grid_bounds[2], grid_bounds[1]+grid_bounds[3]), (255, 0, 0), 2)
+    else:
+        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        threshold, img_thresh = cv2.threshold(img_gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        stage_start = lap(timings, 'threshold', stage_start)
+
+        grid_box, grid_bounds = find_code_matrix(img_thresh, debug_image)
+    stage_start = lap(timings, 'find_matrix', stage_start)
     if grid_box is None:
-        print('Could not find grid...')
-        return None, None, None, None, None
+        logger.info('Could not find grid...')
+        return None, None, None, None, None, None
 
-    targets = extract_targets(img_thresh, code_images, debug_image)
+    target_regions = find_target_regions(img_thresh, debug_image)
+    stage_start = lap(timings, 'targets', stage_start)
 
     buffer_bounds = find_buffer_region(img_thresh, debug_image)
     buffer_size = extract_buffer(img_gray, buffer_bounds, debug_image)
-    print('Buffer is size {0}'.format(buffer_size))
+    logger.debug('Buffer is size %d', buffer_size)
+    stage_start = lap(timings, 'buffer', stage_start)
     
-    grid, boxes = extract_grid(grid_box, grid_bounds, code_images, debug_image)
-    if grid is not None:
-        for row in grid:
-            print(' '.join(row))
-
-    return grid, targets, buffer_size, grid_bounds, boxes
+    grid_regions, cells, boxes = find_grid_regions(grid_box, grid_bounds, debug_image)
+    stage_start = lap(timings, 'grid', stage_start)
+
+    grid, targets, confidence = classify_board(grid_regions, cells, boxes, target_regions, code_templates)
+    stage_start = lap(timings, 'classify', stage_start)
+
+    if logger.isEnabledFor(logging.DEBUG): #don't build the text unless it's going to be logged
+        logger.debug('Targets:\n%s', format_rows(targets))
+        logger.debug('Grid:\n%s', format_rows(grid))
+
+    if regions is not None:
+        regions['shape'] = img.shape[:2]
+        regions['threshold'] = threshold
+        regions['grid_bounds'] = grid_bounds
+        regions['buffer_bounds'] = buffer_bounds
+        regions['grid_size'] = (len(boxes), len(boxes[0]) if boxes else 0)
+    return grid, targets, buffer_size, grid_bounds, boxes, confidence
+
+def run_tracked_extraction(img, regions, timings=None):
+    '''run_extraction for the next frame of a stream, reusing the threshold and the matrix and buffer bounds that run_extraction put in regions
+    instead of finding them again, and only thresholding those regions and the targets. Returns the same as run_extraction,
+    or all None if the regions don't hold the same kind of board any more (a different image size, a different grid size,
+    a different buffer size, no targets, or codes that match poorly), in which case run_extraction has to find them again'''
+    if img.shape[:2] != regions['shape']:
+        return None, None, None, None, None, None
+    code_templates = get_code_templates()
+    grid_bounds = regions['grid_bounds']
+    buffer_bounds = regions['buffer_bounds']
+
+    stage_start = time.perf_counter()
+    buffer_area = (buffer_bounds[0], buffer_bounds[1], buffer_bounds[2] + buffer_bounds[3]//2, buffer_bounds[3]) #with the gap buffer_unchanged checks
+    img_gray, img_thresh = threshold_regions(img, [bounds_roi(grid_bounds), target_roi_bounds(img.shape), bounds_roi(buffer_area)], regions['threshold'])
+    grid_box = img_thresh[grid_bounds[1]:grid_bounds[1]+grid_bounds[3], grid_bounds[0]:grid_bounds[0]+grid_bounds[2]]
+    stage_start = lap(timings, 'threshold', stage_start)
+    if not buffer_unchanged(img_thresh, buffer_bounds):
+        return None, None, None, None, None, None
+
+    target_regions = find_target_regions(img_thresh)
+    stage_start = lap(timings, 'targets', stage_start)
+    buffer_size = extract_buffer(img_gray, buffer_bounds)
+    stage_start = lap(timings, 'buffer', stage_start)
+    grid_regions, cells, boxes = find_grid_regions(grid_box, grid_bounds)
+    stage_start = lap(timings, 'grid', stage_start)
+    if not target_regions or buffer_size == 0 or (len(boxes), len(boxes[0]) if boxes else 0) != regions['grid_size']:
+        return None, None, None, None, None, None
+
+    grid, targets, confidence = classify_board(grid_regions, cells, boxes, target_regions, code_templates)
+    stage_start = lap(timings, 'classify', stage_start)
+    matched = [c for row in confidence['grid'] + confidence['targets'] for c in row]
+    if sum(matched) / len(matched) < UNCERTAIN_CONFIDENCE:
+        return None, None, None, None, None, None
+    return grid, targets, buffer_size, grid_bounds, boxes, confidence
     
 
-def full_process(img, calculate_shortest=False, show_debug_markers=False):
+def full_process(img, calculate_shortest=False, show_debug_markers=False, solver_mode='best_first'):
     timer_overall = time.perf_counter()
 
-    code_images = build_source_codes()
+    code_templates = get_code_templates()
 
     debug_image = None
     if show_debug_markers: 
@@ -264,21 +511,21 @@ def full_process(img, calculate_shortest=False, show_debug_markers=False):
 
     grid_box, grid_bounds = find_code_matrix(img_thresh, debug_image)
     if grid_box is None:
-        print('Could not find grid...')
+        logger.info('Could not find grid...')
         return None, None
 
-    targets = extract_targets(img_thresh, code_images, debug_image)
+    targets = extract_targets(img_thresh, code_templates, debug_image)
+    logger.info('Targets:\n%s', format_rows(targets))
 
     buffer_bounds = find_buffer_region(img_thresh, debug_image)
     buffer_size = extract_buffer(img_gray, buffer_bounds, debug_image)
-    print('Buffer is size {0}'.format(buffer_size))
+    logger.info('Buffer is size %d', buffer_size)
 
     timer_cv_matrix = time.perf_counter()
 
-    grid, boxes = extract_grid(grid_box, grid_bounds, code_images, debug_image)
+    grid, boxes = extract_grid(grid_box, grid_bounds, code_templates, debug_image)
     if grid is not None:
-        for row in grid:
-            print(' '.join(row))
+        logger.info('Grid:\n%s', format_rows(grid))
 
     timer_extract_matrix = time.perf_counter()
 
@@ -286,12 +533,12 @@ def full_process(img, calculate_shortest=False, show_debug_markers=False):
     breach.set_grid(grid)
     breach.set_targets(targets, buffer_size)
 
-    seq, score = breach.solve(shortest=calculate_shortest)
+    seq, score = breach.solve(shortest=calculate_shortest, mode=solver_mode)
     seq_txt = breach.positions_to_text(seq)
     #overlay pattern on original image
     overlay_result(img, seq, boxes, (0, 255, 255), grid_bounds)
-    print('Solution:', seq, seq_txt, score)
-    print('Examined {0} possibilities with {1} valid solutions found.'.format(breach.total_tested, breach.total_solutions))
+    logger.info('Solution: %s %s %s', seq, seq_txt, score)
+    logger.info('Examined %d possibilities with %d valid solutions found. Peak of %d open sequences.', breach.total_tested, breach.total_solutions, breach.peak_frontier)
 
     timer_solve = time.perf_counter()
 
@@ -300,7 +547,7 @@ def full_process(img, calculate_shortest=False, show_debug_markers=False):
     elapsed_extract_matrix = round(timer_extract_matrix - timer_cv_matrix, 2)
     elapsed_solve = round(timer_solve - timer_extract_matrix, 2)
 
-    print('Timing {0}s overall. {1}s find matrix, {2}s matrix extract, {3}s solve.'.format(elapsed_overall, elapsed_cv_matrix, elapsed_extract_matrix, elapsed_solve))
+    logger.info('Timing %ss overall. %ss find matrix, %ss matrix extract, %ss solve.', elapsed_overall, elapsed_cv_matrix, elapsed_extract_matrix, elapsed_solve)
 
     matrix_roi = img[grid_bounds[1]:grid_bounds[1]+grid_bounds[3], 
                         grid_bounds[0]:grid_bounds[0]+grid_bounds[2]]
@@ -314,15 +561,23 @@ def open_image(filename):
 def save_image(img, filename):
     cv2.imwrite(filename, img)
 
+def encode_image(img, extension):
+    '''Encodes the image to the format for the extension (like '.jpg'), returns the bytes'''
+    _, buffer = cv2.imencode(extension, img)
+    return buffer.tobytes()
+
 def base64_encode_image(img, extension):
     '''Base64 encodes the image to a byte-string'''
     _, buffer = cv2.imencode(extension, img)
     return base64.b64encode(buffer)
 
+def decode_image(data):
+    '''Decodes an encoded image (bytes or bytearray) straight from memory to an OpenCV image, without copying the data first'''
+    return cv2.imdecode(numpy.frombuffer(data, numpy.uint8), flags=cv2.IMREAD_COLOR)
+
 def base64_decode_image(base64Bytes):
     '''Takes a base64 encoded image as a byte-string and converts to an OpenCV image'''
-    img = numpy.fromstring(base64.b64decode(base64Bytes), numpy.uint8)
-    return cv2.imdecode(img, flags=cv2.IMREAD_COLOR)
+    return decode_image(base64.b64decode(base64Bytes))
 
 def wait_for_keypress():
     cv2.waitKey()
@@ -340,6 +595,7 @@ if __name__ == "__main__":
     # filename = 'examples/example13_jpg.jpg'
     filename = 'examples/example14_7g_900.png'
     
+    log_config.configure_logging(fmt='%(message)s')
     img = cv2.imread(filename)
     sequence, text = full_process(img, calculate_shortest=False, show_debug_markers=True)
 
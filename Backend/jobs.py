@@ -0,0 +1,370 @@
+# This file handles running long solves in the background, so requests don't have to wait on them
+#builtin
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+#ours
+from breacher import Breacher
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUED = 32
+DEFAULT_TIMEOUT = 30 #seconds
+KEEP_FINISHED = 10 * 60 #seconds a finished job's result can still be fetched for
+POLL_INTERVAL = 0.05 #seconds between checking a running job for results, cancellation or its deadline
+CLAIM_INTERVAL = 0.2 #seconds an idle runner of a SharedJobQueue waits before looking for a queued job again
+LOST_AFTER = 10 #seconds past its deadline a job can still be running before it's taken to have been lost with its worker
+DB_TIMEOUT = 5 #seconds to wait for another process to finish writing the job database
+
+logger = logging.getLogger(__name__)
+
+def solve_job(grid, targets, buffer_size, mode='best_first'):
+    '''Solves a board, the work done for a job. Returns the solution fields.
+    The 'parallel' mode runs as 'optimal' (the same result), a job's daemon process isn't allowed to start the processes it would need'''
+    if mode == 'parallel': mode = 'optimal'
+    breach = Breacher(grid, targets, buffer_size)
+    seq, score = breach.solve(mode=mode)
+    return {
+        'score': score,
+        'sequence': seq,
+        'sequence_text': breach.positions_to_text(seq),
+        'total_tested': breach.total_tested
+    }
+
+def _run_in_process(conn, func, args):
+    '''Entry point of a job's worker process, sends back ('done', result) or ('failed', error)'''
+    try:
+        conn.send(('done', func(*args)))
+    except Exception as e:
+        conn.send(('failed', str(e)))
+    finally:
+        conn.close()
+
+def _run_task(func, args, deadline, cancelled):
+    '''Runs func(*args) in its own process, killing it if cancelled() turns true or the deadline passes.
+    Returns the job's final status, result and error'''
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run_in_process, args=(sender, func, args), daemon=True)
+    process.start()
+    sender.close()
+    try:
+        while not receiver.poll(POLL_INTERVAL):
+            if cancelled():
+                return 'cancelled', None, None
+            if time.time() > deadline:
+                return 'timeout', None, 'Deadline passed while running'
+            if not process.is_alive() and not receiver.poll():
+                return 'failed', None, 'Worker exited with code {0}'.format(process.exitcode)
+        status, value = receiver.recv()
+        if status == 'done': return 'done', value, None
+        return 'failed', None, value
+    except EOFError:
+        return 'failed', None, 'Worker exited with code {0}'.format(process.exitcode)
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        receiver.close()
+
+class Job(object):
+    '''A submitted job. Status goes queued -> running -> done, or ends as failed, cancelled or timeout'''
+    def __init__(self, func, args, timeout) -> None:
+        super().__init__()
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.deadline = self.submitted + timeout
+        self.cancel_requested = threading.Event()
+        self.done = threading.Event()
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self.done.set()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'deadline': self.deadline
+        }
+
+class JobQueue(object):
+    '''Local job broker. Jobs wait in a bounded queue and a fixed number of runner threads each run one at a time in its own process,
+    which is killed if the job is cancelled or goes past its deadline'''
+    def __init__(self, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED, default_timeout=DEFAULT_TIMEOUT) -> None:
+        super().__init__()
+        self.default_timeout = default_timeout
+        self.jobs = {}
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._runners = []
+        for _ in range(workers):
+            runner = threading.Thread(target=self._run, daemon=True)
+            runner.start()
+            self._runners.append(runner)
+
+    def submit(self, func, args, timeout=None):
+        '''Queues func(*args), returns the job or None if the queue is full.
+        timeout (seconds) can only shorten the default timeout, so a job can't hold a runner for longer than that'''
+        if timeout is None or timeout > self.default_timeout:
+            timeout = self.default_timeout
+        job = Job(func, args, timeout)
+        with self._lock:
+            self._forget_old()
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                return None
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id, wait=0):
+        '''Returns the job (or None if there isn't one with that id), waiting up to wait seconds for it to finish first'''
+        job = self.jobs.get(job_id)
+        if job is not None and wait > 0:
+            job.done.wait(wait)
+        return job
+
+    def cancel(self, job_id):
+        '''Cancels the job, stopping it if it's already running. Returns the job or None if there isn't one with that id'''
+        job = self.jobs.get(job_id)
+        if job is not None and not job.done.is_set():
+            job.cancel_requested.set()
+        return job
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def _forget_old(self):
+        cutoff = time.time() - KEEP_FINISHED
+        for job_id in [j.id for j in self.jobs.values() if j.finished is not None and j.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job.cancel_requested.is_set():
+                job.finish('cancelled')
+            elif time.time() > job.deadline:
+                job.finish('timeout', error='Deadline passed while queued')
+            else:
+                self._run_job(job)
+
+    def _run_job(self, job):
+        job.started = time.time()
+        job.status = 'running'
+        try:
+            status, result, error = _run_task(job.func, job.args, job.deadline, job.cancel_requested.is_set)
+        except Exception as e:
+            #the runner has to outlive it, and the job has to finish or anything waiting on it waits for the whole timeout
+            logger.exception('Running job %s failed', job.id)
+            status, result, error = 'failed', None, str(e)
+        job.finish(status, result, error)
+
+class StoredJob(object):
+    '''A job as read from a SharedJobQueue's database, with the same fields as Job'''
+    def __init__(self, row) -> None:
+        super().__init__()
+        self.id = row['id']
+        self.status = row['status']
+        self.result = json.loads(row['result']) if row['result'] is not None else None
+        self.error = row['error']
+        self.submitted = row['submitted']
+        self.started = row['started']
+        self.finished = row['finished']
+        self.deadline = row['deadline']
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'deadline': self.deadline
+        }
+
+class SharedJobQueue(object):
+    '''Job broker kept in a sqlite database, so every process using the same file (each gunicorn worker) sees every job.
+    Each process runs its own runner threads, which claim queued jobs from the database, but no more than workers jobs run at once across all of them.
+    A running job is cancelled by flagging it in the database, which its runner checks while it waits on the job's process'''
+    def __init__(self, path, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED, default_timeout=DEFAULT_TIMEOUT) -> None:
+        super().__init__()
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.default_timeout = default_timeout
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL') #so polls aren't held up by runners writing
+        with self._transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, task BLOB, status TEXT, result TEXT, error TEXT,
+                submitted REAL, started REAL, finished REAL, deadline REAL, cancel_requested INTEGER DEFAULT 0)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted)')
+        self._runners = []
+        for _ in range(workers):
+            runner = threading.Thread(target=self._run, daemon=True)
+            runner.start()
+            self._runners.append(runner)
+
+    def submit(self, func, args, timeout=None):
+        '''Queues func(*args), returns the job or None if the queue is full.
+        timeout (seconds) can only shorten the default timeout, so a job can't hold a runner for longer than that'''
+        if timeout is None or timeout > self.default_timeout:
+            timeout = self.default_timeout
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as conn:
+            self._forget_old(conn, now)
+            if self._count(conn, 'queued') >= self.max_queued:
+                return None
+            conn.execute('INSERT INTO jobs (id, task, status, submitted, deadline) VALUES (?, ?, ?, ?, ?)',
+                (job_id, pickle.dumps((func, args)), 'queued', now, now + timeout))
+        return self._load(job_id)
+
+    def get(self, job_id, wait=0):
+        '''Returns the job (or None if there isn't one with that id), waiting up to wait seconds for it to finish first'''
+        end = time.monotonic() + wait
+        while True:
+            job = self._load(job_id)
+            if job is None or job.finished is not None or time.monotonic() >= end:
+                return job
+            time.sleep(POLL_INTERVAL)
+
+    def cancel(self, job_id):
+        '''Cancels the job, stopping it if it's already running. Returns the job or None if there isn't one with that id'''
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        return self._load(job_id)
+
+    def queued(self):
+        with contextlib.closing(self._connect()) as conn:
+            return self._count(conn, 'queued')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_TIMEOUT, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        '''A connection in a write transaction, committed if the block finishes and rolled back if it raises'''
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _load(self, job_id):
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return StoredJob(row) if row is not None else None
+
+    @staticmethod
+    def _count(conn, status):
+        return conn.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (status,)).fetchone()[0]
+
+    @staticmethod
+    def _forget_old(conn, now):
+        conn.execute('DELETE FROM jobs WHERE finished < ?', (now - KEEP_FINISHED,))
+
+    def _has_work(self, now):
+        '''Whether a claim could change anything: a job is queued and fewer than workers are running, or a running job has been lost.
+        Only reads, so idle runners don't keep taking the write lock from submit and cancel'''
+        with contextlib.closing(self._connect()) as conn:
+            queued, running, lost = conn.execute("""SELECT
+                (SELECT COUNT(*) FROM jobs WHERE status = 'queued'),
+                (SELECT COUNT(*) FROM jobs WHERE status = 'running'),
+                (SELECT COUNT(*) FROM jobs WHERE status = 'running' AND deadline < ?)""", (now - LOST_AFTER,)).fetchone()
+        return (queued > 0 and running < self.workers) or lost > 0
+
+    def _claim(self):
+        '''Marks the oldest queued job as running and returns its id, pickled function and arguments, and deadline.
+        Returns None if there's nothing queued or workers jobs are already running'''
+        now = time.time()
+        if not self._has_work(now):
+            return None
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'timeout', error = 'Deadline passed while queued', finished = ? WHERE status = 'queued' AND deadline < ?", (now, now))
+            #a worker that dies (or is restarted by gunicorn) takes its running jobs with it, they'd otherwise count as running forever
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'Worker lost', finished = ? WHERE status = 'running' AND deadline < ?", (now, now - LOST_AFTER))
+            if self._count(conn, 'running') >= self.workers:
+                return None
+            row = conn.execute("SELECT id, task, deadline FROM jobs WHERE status = 'queued' ORDER BY submitted LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (now, row['id']))
+        return row['id'], row['task'], row['deadline']
+
+    def _cancel_requested(self, job_id):
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row is None or bool(row['cancel_requested'])
+
+    def _finish(self, job_id, status, result, error):
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ? AND status = 'running'",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id))
+
+    def _run(self):
+        while True:
+            job_id = None
+            try:
+                claimed = self._claim()
+                if claimed is None:
+                    time.sleep(CLAIM_INTERVAL)
+                    continue
+                job_id, task, deadline = claimed
+                func, args = pickle.loads(task)
+                status, result, error = _run_task(func, args, deadline, lambda: self._cancel_requested(job_id))
+                self._finish(job_id, status, result, error)
+            except Exception as e:
+                #the runner has to outlive anything a job or the database throws at it, or its job would be left running
+                logger.exception('Running job %s failed', job_id)
+                if job_id is not None:
+                    try:
+                        self._finish(job_id, 'failed', None, str(e))
+                    except sqlite3.Error:
+                        pass #it's marked lost by a later claim instead
+                time.sleep(CLAIM_INTERVAL)
+
+def create_job_queue():
+    '''Builds the job queue from the environment: BREACHER_JOB_WORKERS, BREACHER_JOB_QUEUE (max queued jobs) and BREACHER_JOB_TIMEOUT (seconds).
+    BREACHER_JOB_DB (a sqlite file) shares the jobs between every process using it, otherwise they're kept in this process'''
+    options = (
+        int(os.environ.get('BREACHER_JOB_WORKERS', DEFAULT_WORKERS)),
+        int(os.environ.get('BREACHER_JOB_QUEUE', DEFAULT_MAX_QUEUED)),
+        float(os.environ.get('BREACHER_JOB_TIMEOUT', DEFAULT_TIMEOUT))
+    )
+    path = os.environ.get('BREACHER_JOB_DB')
+    if path:
+        return SharedJobQueue(path, *options)
+    return JobQueue(*options)
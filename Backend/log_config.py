@@ -0,0 +1,53 @@
+# This file handles setting up logging, which goes through a queue so logging never blocks the caller on I/O
+#builtin
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+
+DEFAULT_FORMAT = '%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'
+
+request_id = contextvars.ContextVar('request_id', default='-') # id of the request being handled, set by the web api
+_listener = None
+_queue_handler = None
+
+class RequestIdFilter(logging.Filter):
+    '''Tags every record with the id of the request it was logged for'''
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+def configure_logging(level=None, fmt=DEFAULT_FORMAT):
+    '''Sends all logging through a queue to a background thread that writes it to stderr. The level defaults to BREACHER_LOG_LEVEL, or INFO.
+    Only the first call does anything. Forked processes (gunicorn workers, process pools) get a listener of their own'''
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    if level is None:
+        level = os.environ.get('BREACHER_LOG_LEVEL', 'INFO').upper()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt))
+    log_queue = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    _queue_handler.addFilter(RequestIdFilter()) #runs in the thread that logged, so it sees that request's id
+
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(_listener.stop) #flush whatever is still queued
+    os.register_at_fork(after_in_child=_restart_listener)
+
+def _restart_listener():
+    '''A forked process only has the thread that forked, so without a listener of its own everything it logs would just queue up.
+    It gets a fresh queue too, anything still in the old one is the parent's to write'''
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers)
+    _listener.start()
+    atexit.register(_listener.stop)
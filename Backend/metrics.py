@@ -0,0 +1,205 @@
+# This file handles collecting timings and counters and rendering them in the Prometheus text format
+#builtin
+import atexit
+import json
+import os
+import threading
+import time
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #seconds
+COUNT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+FLUSH_INTERVAL = 5 #seconds between writes of a process's values to BREACHER_METRICS_DIR, well under any scrape interval
+
+_registry = []
+_directory = os.environ.get('BREACHER_METRICS_DIR') # where every process writes its values when there are several (gunicorn workers), see flush
+_flush_lock = threading.Lock()
+_flusher = None
+_changed = False # whether anything was recorded since the last flush
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    '''A count that only goes up, one per combination of label values'''
+    def __init__(self, name, description, labels=()) -> None:
+        super().__init__()
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        global _changed
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _changed = True
+
+    def snapshot(self):
+        '''A copy of the values, label values -> count'''
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(values, key, value):
+        '''Adds another process's value for the label values into a snapshot'''
+        values[key] = values.get(key, 0) + value
+
+    def render(self, values):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} counter'.format(self.name)]
+        for key, value in sorted(values.items()):
+            lines.append('{0}{1} {2}'.format(self.name, format_labels(self.labels, key), format_value(value)))
+        return lines
+
+class Histogram(object):
+    '''Counts of observed values falling in each bucket (cumulative, as Prometheus expects) plus their sum, one per combination of label values'''
+    def __init__(self, name, description, labels=(), buckets=TIME_BUCKETS) -> None:
+        super().__init__()
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {} # label values -> [bucket counts, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        global _changed
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0]
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+        _changed = True
+
+    def snapshot(self):
+        '''A copy of the values, label values -> [bucket counts, sum]'''
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def merge(values, key, value):
+        '''Adds another process's bucket counts and sum for the label values into a snapshot'''
+        entry = values.get(key)
+        if entry is None:
+            values[key] = [list(value[0]), value[1]]
+            return
+        entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+        entry[1] += value[1]
+
+    def render(self, values):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} histogram'.format(self.name)]
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(self.name, format_labels(self.labels, key, [('le', format_value(bound))]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, format_labels(self.labels, key), cumulative))
+        return lines
+
+def flush():
+    '''Writes this process's values to BREACHER_METRICS_DIR (if it's set) for whichever process renders the metrics to add up.
+    Each process has its own file, which stays after it exits so the totals never go down'''
+    global _changed
+    if _directory is None:
+        return
+    _changed = False #before taking the snapshot, so anything recorded while writing is caught next time
+    data = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in _registry}
+    path = os.path.join(_directory, '{0}.json'.format(os.getpid()))
+    with _flush_lock:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path) #so readers never see half a file
+
+def start_flushing(interval=FLUSH_INTERVAL):
+    '''Flushes every interval seconds from a background thread, if anything was recorded since the last time, and once more at exit.
+    Only the first call does anything, and only if BREACHER_METRICS_DIR is set. Forked processes get a thread of their own'''
+    global _flusher
+    if _directory is None or _flusher is not None:
+        return
+    _flusher = threading.Thread(target=_flush_periodically, args=(interval,), daemon=True)
+    _flusher.start()
+    atexit.register(flush)
+    os.register_at_fork(after_in_child=lambda: _restart_flushing(interval))
+
+def _flush_periodically(interval):
+    while True:
+        time.sleep(interval)
+        if _changed:
+            flush()
+
+def _restart_flushing(interval):
+    '''A forked process only has the thread that forked. What was counted before the fork is the parent's to report, so it starts from nothing'''
+    global _flusher, _flush_lock, _changed
+    _flush_lock = threading.Lock() #the parent's flusher could have been holding it
+    _changed = False
+    for metric in _registry:
+        metric._lock = threading.Lock()
+        metric._values = {}
+    _flusher = threading.Thread(target=_flush_periodically, args=(interval,), daemon=True)
+    _flusher.start()
+
+def totals():
+    '''Every metric's values (metric name -> snapshot), totalled over every process if BREACHER_METRICS_DIR is set.
+    The other processes' values are as of their last flush'''
+    values = {metric.name: metric.snapshot() for metric in _registry}
+    if _directory is not None:
+        own = '{0}.json'.format(os.getpid())
+        for filename in os.listdir(_directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(_directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for metric in _registry:
+                for key, value in data.get(metric.name, []):
+                    metric.merge(values[metric.name], tuple(key), value)
+    return values
+
+def render():
+    '''Every metric in the Prometheus text exposition format, totalled over every process if BREACHER_METRICS_DIR is set'''
+    values = totals()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render(values[metric.name]))
+    return '\n'.join(lines) + '\n'
+
+REQUESTS = Counter('breacher_requests_total', 'Requests handled, by endpoint and status code', ['endpoint', 'status'])
+REQUEST_SECONDS = Histogram('breacher_request_seconds', 'Time to handle a request, by endpoint', ['endpoint'])
+STAGE_SECONDS = Histogram('breacher_stage_seconds', 'Time spent in each stage of extracting and solving', ['stage'])
+SOLVES = Counter('breacher_solves_total', 'Boards solved, by mode and whether every target was completed', ['mode', 'result'])
+SOLVER_NODES = Histogram('breacher_solver_nodes_expanded', 'Sequences expanded per solve', ['mode'], COUNT_BUCKETS)
+SOLVER_PEAK_FRONTIER = Histogram('breacher_solver_peak_frontier', 'Most open sequences at once per solve', ['mode'], COUNT_BUCKETS)
+SOLVER_BUDGET_EXHAUSTED = Counter('breacher_solver_budget_exhausted_total', 'Solves cut short by their time or node budget', ['mode'])
+CACHE_LOOKUPS = Counter('breacher_cache_lookups_total', 'Solution cache lookups, by hit or miss', ['result'])
+
+def record_timings(timings):
+    '''Observes every stage in a timings dict (stage -> seconds)'''
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+def record_solve(breach, mode, score):
+    '''Records the counters of a finished solve'''
+    SOLVES.inc(mode=mode, result='complete' if score >= breach.max_value else 'partial')
+    SOLVER_NODES.observe(breach.nodes_expanded, mode=mode)
+    SOLVER_PEAK_FRONTIER.observe(breach.peak_frontier, mode=mode)
+    if breach.budget_exhausted:
+        SOLVER_BUDGET_EXHAUSTED.inc(mode=mode)
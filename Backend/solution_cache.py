@@ -0,0 +1,101 @@
+# This file handles caching solved boards so repeated submissions don't have to be solved again
+#builtin
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL = 60 * 60 #seconds
+REDIS_TIMEOUT = 0.5 #seconds a redis command can take before it counts as failed, the board is solved instead
+
+logger = logging.getLogger(__name__)
+
+def board_key(grid, targets, buffer_size, mode):
+    '''Canonical hash of a board, the same board always gives the same key no matter how the JSON was formatted'''
+    canonical = json.dumps([
+        [[str(code) for code in row] for row in grid],
+        [[str(code) for code in tgt] for tgt in targets],
+        int(buffer_size),
+        mode
+    ], separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class SolutionCache(object):
+    '''In-process LRU cache of solutions with a time to live. Safe to share between request threads'''
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL) -> None:
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict() # key -> (expiry time, solution)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the cached solution for the key, or None if it isn't cached or has expired'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, solution):
+        '''Caches the solution (a JSON serializable dict), evicting the least recently used one if full'''
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, solution)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def size(self):
+        return len(self._entries)
+
+class RedisSolutionCache(object):
+    '''Solution cache shared between replicas through redis, which handles the eviction and time to live.
+    If redis fails or is slow, lookups count as misses and nothing is stored, so boards just get solved.
+    Needs the redis package, which isn't in the base requirements'''
+    def __init__(self, url, ttl=DEFAULT_TTL, prefix='breacher:solution:') -> None:
+        super().__init__()
+        import redis #only needed when a shared cache is configured
+        self.client = redis.Redis.from_url(url, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+        self.errors = redis.RedisError
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except self.errors as e:
+            logger.warning('Solution cache lookup failed: %s', e)
+            value = None
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def put(self, key, solution):
+        try:
+            self.client.set(self.prefix + key, json.dumps(solution), ex=self.ttl)
+        except self.errors as e:
+            logger.warning('Storing solution in cache failed: %s', e)
+
+    def size(self):
+        '''Not tracked, counting the shared keys would mean scanning all of redis'''
+        return None
+
+def create_cache():
+    '''Builds the cache from the environment. BREACHER_CACHE_URL (redis://...) shares the cache between replicas,
+    otherwise it's kept in process. BREACHER_CACHE_SIZE and BREACHER_CACHE_TTL (seconds) tune it, a size of 0 turns it off'''
+    max_size = int(os.environ.get('BREACHER_CACHE_SIZE', DEFAULT_MAX_SIZE))
+    ttl = int(os.environ.get('BREACHER_CACHE_TTL', DEFAULT_TTL))
+    if max_size <= 0:
+        return None
+    url = os.environ.get('BREACHER_CACHE_URL')
+    if url:
+        return RedisSolutionCache(url, ttl)
+    return SolutionCache(max_size, ttl)
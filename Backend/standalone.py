@@ -1,21 +1,36 @@
+import logging
 import sys
 
+import capture
 import image_processing
+import log_config
 
 args = sys.argv
 if len(args) < 2:
-    print('Must provide filename. standalone.py file.png')
+    print('Must provide filename. standalone.py file.png, or standalone.py video.mp4|frame_directory stream [headless]')
     exit(1)
 
 
 shortest = False
 debug = False
+stream = False
+show = True
+mode = 'best_first'
 
 for arg in args:
     if arg == 'debug': debug = True
     elif arg == 'shortest': shortest = True
+    elif arg == 'optimal': mode = 'optimal'
+    elif arg == 'stream': stream = True
+    elif arg == 'headless': show = False
+
+log_config.configure_logging(logging.DEBUG if debug else logging.INFO, '%(message)s')
 
 filename = args[1]
+if stream:
+    capture.run_stream(filename, mode, shortest, show)
+    exit(0)
+
 img = image_processing.open_image(filename)
-seq, seq_t = image_processing.full_process(img, shortest, debug)
+seq, seq_t = image_processing.full_process(img, shortest, debug, mode)
 image_processing.wait_for_keypress()
\ No newline at end of file
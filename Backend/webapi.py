@@ -1,50 +1,136 @@
+import base64
+import concurrent.futures
+import contextlib
+import io
+import json
+import logging
 import os
-import uuid
+import threading
 import time
+import uuid
 
-from flask import Flask, request
-from flask.helpers import send_file
+from flask import Flask, Request, Response, g, request
+from werkzeug.exceptions import RequestEntityTooLarge
 
 import image_processing
-from breacher import Breacher
+import jobs
+import log_config
+import metrics
+import solution_cache
+from breacher import Breacher, SOLVER_MODES, available_cpus, board_result, set_parallel_pool_processes, solve_batch
 
 ALLOWED_EXTENSIONS = set(['.png', '.jpg', '.jpeg'])
+MAX_JOB_WAIT = 30 #seconds a job poll can wait for the job to finish
+MAX_BATCH_BOARDS = 10000
+WARM_UP_BOARD = ([['1C', '55'], ['55', '1C']], [['1C', '55', '1C']], 3)
+CACHED_FIELDS = ('score', 'sequence', 'sequence_text', 'proven_optimal', 'budget_exhausted')
+HEADER_FIELDS = ('score', 'sequence', 'sequence_text') # all /solve puts in its header with the jpeg format, the grid and everything else can get past 4KB
+
+log_config.configure_logging()
+metrics.start_flushing()
+logger = logging.getLogger(__name__)
+
+class UploadBuffer(io.BytesIO):
+    '''In-memory file for an upload, which counts what's written to every upload of its request
+    and rejects the request (413) as soon as they add up to more than MAX_CONTENT_LENGTH'''
+    def __init__(self, request) -> None:
+        super().__init__()
+        self.request = request
+
+    def write(self, data):
+        self.request.upload_size += len(data)
+        limit = self.request.max_content_length
+        if limit is not None and self.request.upload_size > limit:
+            raise RequestEntityTooLarge()
+        return super().write(data)
+
+class InMemoryRequest(Request):
+    '''Keeps uploaded files in memory, werkzeug would otherwise spool anything over 500KB to a temporary file.
+    MAX_CONTENT_LENGTH only rejects bodies that say how long they are up front, chunked ones are limited by UploadBuffer while they're read'''
+    upload_size = 0
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadBuffer(self)
 
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 #16 megs
+app.request_class = InMemoryRequest
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 #16 megs, larger requests are rejected with a 413
+
+def solver_processes():
+    '''Number of processes each of this process's solver pools (parallel and batch) gets, the available CPUs split between the
+    BREACHER_WORKERS server processes. Otherwise every gunicorn worker would start a pool process per CPU for each pool'''
+    return max(1, available_cpus() // int(os.environ.get('BREACHER_WORKERS', 1)))
+
+cache = solution_cache.create_cache()
+set_parallel_pool_processes(solver_processes())
+job_queue = None # started on first use, its runner threads wouldn't survive a fork
+batch_pool = None # same for the batch process pool
+_job_queue_lock = threading.Lock() # requests are handled on several threads, the first ones mustn't each start their own
+_batch_pool_lock = threading.Lock()
+def warm_up():
+    '''Does everything the first request would otherwise wait on: loading the code templates, the first classification and the first solve.
+    Run at import, so with gunicorn's preload it happens once in the master and the workers share the result.
+    gunicorn only binds its port after that, so nothing is served (and no readiness probe passes) until it's done'''
+    start = time.perf_counter()
+    code_templates = image_processing.get_code_templates()
+    image_processing.classify_regions(list(image_processing.build_source_codes().values()), code_templates)
+    Breacher(*WARM_UP_BOARD).solve()
+    logger.info('Warmed up in %.2fs', time.perf_counter() - start)
+
+warm_up()
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    log_config.request_id.set(g.request_id) # tags everything logged while handling this request
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if 'start' in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
 
 @app.route('/')
 def healthcheck():
     return 'Success', 200
 
+@app.route('/metrics', methods = ['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/extract', methods = ['POST'])
 def extract():
     if 'file' not in request.files:
-        print('No file part')
+        logger.info('No file part')
         return 'No file part', 400
     file = request.files['file']
     if file.filename == '':
-        print('No selected file')
+        logger.info('No selected file')
         return 'No selected file', 400
     if file and allowed_file(file.filename):
-        filename = ''
         try:
-            _, ext = os.path.splitext(file.filename)
-            filename = str(uuid.uuid4()) + ext
-            file.save(filename)
-
             start = time.perf_counter()
 
-            img = image_processing.open_image(filename)
-            if os.path.exists(filename): os.remove(filename)
-            grid, targets, buffer, grid_bounds, boxes = image_processing.run_extraction(img, False)
+            img = image_processing.decode_image(file.stream.getbuffer()) #straight from the upload's memory, see InMemoryRequest
+            if img is None:
+                return 'Could not decode image', 400
+            timings = {'decode': time.perf_counter() - start}
+            grid, targets, buffer, grid_bounds, boxes, confidence = image_processing.run_extraction(img, False, coarse=True, timings=timings)
             
             if grid is None:
                 return 'Could not find grid', 400
 
+            stage_start = time.perf_counter()
             img_cropped = img[grid_bounds[1]:grid_bounds[1]+grid_bounds[3], grid_bounds[0]:grid_bounds[0]+grid_bounds[2]]
 
             base64_image = image_processing.base64_encode_image(img_cropped, '.jpg').decode()
+            image_processing.lap(timings, 'encode', stage_start)
+            metrics.record_timings(timings)
 
             elapsed = time.perf_counter() - start
 
@@ -54,65 +140,358 @@ def extract():
                 'grid': grid,
                 'matrix_image': base64_image,
                 'elapsed': elapsed,
-                'grid_boxes': boxes
+                'timings': timings,
+                'grid_boxes': boxes,
+                'confidence': confidence,
+                'uncertain': {
+                    'grid': image_processing.find_uncertain(confidence['grid']),
+                    'targets': image_processing.find_uncertain(confidence['targets'])
+                }
             }
 
             return resp, 200
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('Extraction failed')
             return 'Error', 500
-        finally:
-            if filename and os.path.exists(filename):
-                os.remove(filename)
 
     return 'Failed to process', 400
 
 @app.route('/breach', methods = ['POST'])
 def breach():
+    '''Solves an extracted board. Optional fields: mode (solver mode), time_budget (seconds) and node_budget to cap the solve,
+    stream to get server-sent events, an 'improved' event for every better sequence found and then a 'result' event with the full response,
+    and timings to get the time of each stage and the solver's counters in the response'''
     if not request.is_json:
         return 'JSON data expected', 400
     data = request.json
     img = None
     try:
         start = time.perf_counter()
+        timings = {}
 
         if 'matrix_image' in data and data['matrix_image']:
             img = image_processing.base64_decode_image(data['matrix_image'])
+            image_processing.lap(timings, 'decode', start)
 
         grid = data['grid']
         targets = data['targets']
         buffer = data['buffer_size']
         boxes = data['grid_boxes']
+        mode = data.get('mode', 'best_first')
+        if mode not in SOLVER_MODES:
+            return 'Unknown solver mode', 400
+        time_budget = data.get('time_budget')
+        node_budget = data.get('node_budget')
+        if not valid_budgets(time_budget, node_budget):
+            return 'Budgets must be positive numbers', 400
+
+        breakdown = bool(data.get('timings'))
+
+        if data.get('stream'):
+            return Response(stream_board(grid, targets, buffer, mode, time_budget, node_budget, img, boxes, start, timings, breakdown), mimetype='text/event-stream')
         
-        breach = Breacher(grid, targets, buffer)
-        seq, score = breach.solve()
-        seq_txt = breach.positions_to_text(seq)
+        stage_start = time.perf_counter()
+        resp = solve_board(grid, targets, buffer, mode, time_budget, node_budget)
+        image_processing.lap(timings, 'solve', stage_start)
+        finish_breach(resp, img, boxes, start, timings, breakdown)
 
-        resp = {
-            'score': score,
-            'sequence': seq,
-            'sequence_text': seq_txt
-        }
+        return resp, 200
+    except Exception:
+        logger.exception('Solve failed')
+        return 'Error', 500
 
-        if img is not None:
-            # filename = str(uuid.uuid4())
-            # image_processing.save_image(img, filename + '.jpg')
-            image_processing.overlay_result(img, seq, boxes, (255, 255, 0))
-            # image_processing.save_image(img, filename + '_solution.jpg')
-            base64_image = image_processing.base64_encode_image(img, '.jpg').decode()
-            resp['solution_image'] = base64_image
+    # return 'Failed to process', 400
 
-        elapsed = time.perf_counter() - start
+@app.route('/solve', methods = ['POST'])
+def solve():
+    '''Extracts and solves an uploaded screenshot in one go. Optional form fields: mode (solver mode)
+    and format ('json' for the overlay as base64 in the JSON, 'jpeg' for the overlay as the raw response body with the solution in the X-Breacher-Result header).
+    The header only holds the solution (HEADER_FIELDS) so it stays well under the header size limits of proxies, the rest is only in the JSON format'''
+    if 'file' not in request.files:
+        return 'No file part', 400
+    file = request.files['file']
+    if file.filename == '' or not allowed_file(file.filename):
+        return 'No valid file', 400
+    mode = request.form.get('mode', 'best_first')
+    if mode not in SOLVER_MODES:
+        return 'Unknown solver mode', 400
+    output_format = request.form.get('format', 'json')
+    if output_format not in ('json', 'jpeg'):
+        return 'Unknown format', 400
+    try:
+        start = time.perf_counter()
+
+        img = image_processing.decode_image(file.stream.getbuffer())
+        if img is None:
+            return 'Could not decode image', 400
+        timings = {'decode': time.perf_counter() - start}
+        grid, targets, buffer, grid_bounds, boxes, confidence = image_processing.run_extraction(img, False, coarse=True, timings=timings)
+        if grid is None:
+            return 'Could not find grid', 400
+
+        stage_start = time.perf_counter()
+        resp = solve_board(grid, targets, buffer, mode)
+        stage_start = image_processing.lap(timings, 'solve', stage_start)
+
+        img_cropped = img[grid_bounds[1]:grid_bounds[1]+grid_bounds[3], grid_bounds[0]:grid_bounds[0]+grid_bounds[2]]
+        image_processing.overlay_result(img_cropped, resp['sequence'], boxes, (255, 255, 0))
+        stage_start = image_processing.lap(timings, 'overlay', stage_start)
+        solution_image = image_processing.encode_image(img_cropped, '.jpg')
+        stage_start = image_processing.lap(timings, 'encode', stage_start)
+        metrics.record_timings(timings)
 
-        resp['elapsed'] = elapsed
+        resp.update({
+            'buffer_size': buffer,
+            'targets': targets,
+            'grid': grid,
+            'grid_boxes': boxes,
+            'confidence': confidence,
+            'uncertain': {
+                'grid': image_processing.find_uncertain(confidence['grid']),
+                'targets': image_processing.find_uncertain(confidence['targets'])
+            },
+            'timings': timings,
+            'elapsed': time.perf_counter() - start
+        })
 
+        if output_format == 'jpeg':
+            return Response(solution_image, mimetype='image/jpeg', headers={'X-Breacher-Result': json.dumps({field: resp[field] for field in HEADER_FIELDS})})
+        resp['solution_image'] = base64.b64encode(solution_image).decode()
         return resp, 200
-    except Exception as e:
-        print(e)
+    except Exception:
+        logger.exception('Extract and solve failed')
         return 'Error', 500
 
-    # return 'Failed to process', 400
+@app.route('/breach/batch', methods = ['POST'])
+def breach_batch():
+    '''Solves many boards at once. Takes 'boards', a list of objects with grid, targets and buffer_size, plus the optional /breach fields
+    (mode, time_budget, node_budget). Streams back NDJSON, one line per board in the order they finish, each with its index in the list'''
+    if not request.is_json:
+        return 'JSON data expected', 400
+    data = request.json
+    try:
+        mode = data.get('mode', 'best_first')
+        if mode not in SOLVER_MODES:
+            return 'Unknown solver mode', 400
+        boards = [(board['grid'], board['targets'], board['buffer_size']) for board in data['boards']]
+        if len(boards) > MAX_BATCH_BOARDS:
+            return 'Too many boards', 413
+        options = {'time_budget': data.get('time_budget'), 'node_budget': data.get('node_budget')}
+        if not valid_budgets(**options):
+            return 'Budgets must be positive numbers', 400
+        return Response(stream_batch(boards, mode, options), mimetype='application/x-ndjson')
+    except Exception:
+        logger.exception('Batch solve failed')
+        return 'Error', 500
+
+@app.route('/jobs', methods = ['POST'])
+def submit_job():
+    '''Queues a solve to run in the background. Takes the /breach JSON (without the image) plus an optional timeout in seconds,
+    which is capped at BREACHER_JOB_TIMEOUT. Returns the job id to poll, or 429 if too many jobs are already waiting'''
+    if not request.is_json:
+        return 'JSON data expected', 400
+    data = request.json
+    try:
+        mode = data.get('mode', 'best_first')
+        if mode not in SOLVER_MODES:
+            return 'Unknown solver mode', 400
+        timeout = data.get('timeout')
+        if timeout is not None and not positive_number(timeout):
+            return 'Timeout must be a positive number of seconds', 400
+        job = get_job_queue().submit(jobs.solve_job, (data['grid'], data['targets'], data['buffer_size'], mode), timeout)
+        if job is None:
+            return 'Too many jobs queued', 429
+        return job.to_dict(), 202
+    except Exception:
+        logger.exception('Submitting job failed')
+        return 'Error', 500
+
+@app.route('/jobs/<job_id>', methods = ['GET'])
+def get_job(job_id):
+    '''Gets a job's status and result. With ?wait=seconds it long-polls, returning as soon as the job finishes'''
+    try:
+        wait = min(float(request.args.get('wait', 0)), MAX_JOB_WAIT)
+    except ValueError:
+        return 'Wait must be a number of seconds', 400
+    job = get_job_queue().get(job_id, wait)
+    if job is None:
+        return 'No such job', 404
+    return job.to_dict(), 200
+
+@app.route('/jobs/<job_id>', methods = ['DELETE'])
+def cancel_job(job_id):
+    job = get_job_queue().cancel(job_id)
+    if job is None:
+        return 'No such job', 404
+    return job.to_dict(), 200
+
+@app.route('/cache', methods = ['GET'])
+def cache_stats():
+    '''Solution cache hits and misses, totalled over every worker like /metrics.
+    size is only the cached boards of the worker that answers, each has its own cache unless it's shared through redis (then it's null)'''
+    if cache is None:
+        return {'enabled': False}, 200
+    lookups = metrics.totals()[metrics.CACHE_LOOKUPS.name]
+    return {
+        'enabled': True,
+        'hits': lookups.get(('hit',), 0),
+        'misses': lookups.get(('miss',), 0),
+        'size': cache.size()
+    }, 200
+
+
+def get_job_queue():
+    global job_queue
+    with _job_queue_lock:
+        if job_queue is None:
+            job_queue = jobs.create_job_queue()
+        return job_queue
+
+def batch_workers():
+    '''Number of processes batches are solved in, BREACHER_BATCH_WORKERS (defaults to this process's share of the CPUs)'''
+    workers = os.environ.get('BREACHER_BATCH_WORKERS')
+    return int(workers) if workers else solver_processes()
+
+def get_batch_pool():
+    '''The process pool batches are solved in'''
+    global batch_pool
+    with _batch_pool_lock:
+        if batch_pool is None:
+            batch_pool = concurrent.futures.ProcessPoolExecutor(max_workers=batch_workers())
+        return batch_pool
+
+def discard_batch_pool(pool):
+    '''Forgets the batch pool if it's still the given (broken) one, so the next batch starts a new one'''
+    global batch_pool
+    with _batch_pool_lock:
+        if batch_pool is pool:
+            batch_pool = None
+    pool.shutdown(wait=False)
+
+def stream_batch(boards, mode, options):
+    '''NDJSON lines for a batch, cached boards first and then the rest as the pool finishes them'''
+    try:
+        keys = [solution_cache.board_key(grid, targets, buffer, mode) for grid, targets, buffer in boards]
+        to_solve = []
+        for index, key in enumerate(keys):
+            resp = cached_solution(key)
+            if resp is None:
+                to_solve.append(index)
+                continue
+            resp['index'] = index
+            yield json.dumps(resp) + '\n'
+        pool = get_batch_pool()
+        for position, result in solve_batch([boards[i] for i in to_solve], mode, batch_workers(), executor=pool, **options):
+            index = to_solve[position]
+            if cache is not None and 'error' not in result and not result['budget_exhausted']:
+                cache.put(keys[index], {k: result[k] for k in CACHED_FIELDS})
+            resp = dict(result)
+            resp['index'] = index
+            resp['cached'] = False
+            yield json.dumps(resp) + '\n'
+    except concurrent.futures.BrokenExecutor:
+        #a pool process died (killed for memory, say), without a new pool every batch after this would fail too
+        logger.exception('Batch pool broke, starting a new one for the next batch')
+        discard_batch_pool(pool)
+        yield json.dumps({'error': 'Error'}) + '\n'
+    except Exception:
+        logger.exception('Streaming batch failed')
+        yield json.dumps({'error': 'Error'}) + '\n'
+
+def cached_solution(key):
+    '''Returns the response fields for the board key from the solution cache, or None if it isn't cached'''
+    if cache is None:
+        return None
+    resp = cache.get(key)
+    metrics.CACHE_LOOKUPS.inc(result='miss' if resp is None else 'hit')
+    if resp is not None:
+        resp = dict(resp)
+        resp['cached'] = True
+    return resp
+
+def solution_fields(breach, seq, score, key, mode):
+    '''Response fields for a finished solve, caching it unless the solve was cut short by its budget. Also records the solver's metrics'''
+    metrics.record_solve(breach, mode, score)
+    result = board_result(breach, seq, score)
+    resp = {field: result[field] for field in CACHED_FIELDS}
+    if cache is not None and not breach.budget_exhausted:
+        cache.put(key, dict(resp))
+    resp['cached'] = False
+    resp['solver'] = {
+        'nodes_expanded': breach.nodes_expanded,
+        'peak_frontier': breach.peak_frontier,
+        'total_tested': breach.total_tested
+    }
+    return resp
+
+def solve_board(grid, targets, buffer, mode, time_budget=None, node_budget=None):
+    '''Solves the board, or gets it from the solution cache. Returns the response fields for the solution'''
+    key = solution_cache.board_key(grid, targets, buffer, mode)
+    resp = cached_solution(key)
+    if resp is not None:
+        return resp
+
+    breach = Breacher(grid, targets, buffer)
+    seq, score = breach.solve(mode=mode, time_budget=time_budget, node_budget=node_budget)
+    return solution_fields(breach, seq, score, key, mode)
+
+def stream_board(grid, targets, buffer, mode, time_budget, node_budget, img, boxes, start, timings, breakdown):
+    '''Server-sent events for a /breach solve, an 'improved' event per better sequence and a final 'result' event'''
+    try:
+        stage_start = time.perf_counter()
+        key = solution_cache.board_key(grid, targets, buffer, mode)
+        resp = cached_solution(key)
+        if resp is None:
+            breach = Breacher(grid, targets, buffer)
+            seq, score = [], 0.0
+            #closed as soon as this generator is, which cancels the solve if the client went away
+            with contextlib.closing(breach.solve_progressive(mode=mode, time_budget=time_budget, node_budget=node_budget)) as improvements:
+                for seq, score in improvements:
+                    yield sse_event('improved', {
+                        'score': score,
+                        'sequence': seq,
+                        'sequence_text': breach.positions_to_text(seq),
+                        'elapsed': time.perf_counter() - start
+                    })
+            resp = solution_fields(breach, seq, score, key, mode)
+        image_processing.lap(timings, 'solve', stage_start)
+        finish_breach(resp, img, boxes, start, timings, breakdown)
+        yield sse_event('result', resp)
+    except Exception:
+        logger.exception('Streaming solve failed')
+        yield sse_event('error', {'error': 'Error'})
+
+def sse_event(event, data):
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+
+def finish_breach(resp, img, boxes, start, timings, breakdown=False):
+    '''Adds the solution overlay (if there's an image) and the elapsed time to a /breach response, and records its stage timings.
+    With breakdown the timings are added to the response and the solver's counters are kept, otherwise the counters are left out'''
+    if img is not None:
+        stage_start = time.perf_counter()
+        # filename = str(uuid.uuid4())
+        # image_processing.save_image(img, filename + '.jpg')
+        image_processing.overlay_result(img, resp['sequence'], boxes, (255, 255, 0))
+        stage_start = image_processing.lap(timings, 'overlay', stage_start)
+        # image_processing.save_image(img, filename + '_solution.jpg')
+        base64_image = image_processing.base64_encode_image(img, '.jpg').decode()
+        image_processing.lap(timings, 'encode', stage_start)
+        resp['solution_image'] = base64_image
+
+    metrics.record_timings(timings)
+    resp['elapsed'] = time.perf_counter() - start
+    if breakdown:
+        resp['timings'] = timings
+    else:
+        resp.pop('solver', None)
+
+def positive_number(value):
+    '''Whether a JSON value is a number above 0, booleans don't count'''
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and value > 0
 
+def valid_budgets(time_budget, node_budget):
+    '''Whether the optional solve budgets are either left out or positive numbers'''
+    return all(budget is None or positive_number(budget) for budget in (time_budget, node_budget))
 
 def allowed_file(filename):
     _, ext = os.path.splitext(filename)